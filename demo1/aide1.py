@@ -5,48 +5,43 @@ from langchain_core.tools import tool
 from langchain_ollama import ChatOllama
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks import BaseCallbackHandler
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
 
 # 直接使用核心功能
-import ragde1, astde1
+import ragde1, astde1, cachede1, ctxde1, logde1, perfde1, triagede1
+
+# 审核模型
+REVIEW_MODEL = "qwen3:4b"
+# 提示模板版本：改动模板或上下文打包方式时递增，让 LLM 回答缓存失效
+PROMPT_VERSION = "2"
+# 确定性模式下使用的固定随机种子
+REVIEW_SEED = 42
+
+# 把违规列表整理成文字报告
+# 违规报告的格式化放在 ragde1 里，只需要报告的地方（比如仓库模式的子进程）不用导入 langchain
+format_report = ragde1.format_report
 
 # 定义query函数，用于RAG规则匹配
+@perfde1.timed("review.query")
 def query(code: str):
     """
     用于RAG规则匹配，检测代码中的违规问题
     参数是要审查的代码
     """
-    res = astde1.analyze_code(code)
-    col = ragde1.init_rag_db()
-    fin_res = ragde1.rag_check(col, res)
-    if not fin_res:
-        return "代码分析完成，未发现明显的违规问题。"
-    
-    report = "发现以下代码违规问题：\n"
-    for v in fin_res:
-        report += f"- 代码片段: {v['code']}\n"
-        report += f"  触发场景: {v.get('context', 'unknown')}\n"
-        report += f"  严重程度: {v['severity']}\n"
-        report += f"  违规原因: {v['rule']}\n\n"
-        
-    return report
+    res = astde1.extract_calls(code)
+    # 规则库句柄在进程里只初始化一次，之后的审查直接复用
+    fin_res = ragde1.get_rule_store().check(res)
+    return format_report(fin_res)
 
-# 定义AI审核函数
-def ai_code_review(code: str, rag_report: str):
-    """
-    使用AI模型对代码进行智能审核
-    参数：
-    - code: 要审查的代码
-    - rag_report: RAG规则匹配生成的报告
-    """
-    # 创建AI模型
-    model = ChatOllama(
-        model="qwen3:4b",
-        temperature=1.0
-    )
-    
-    # 定义提示模板，使用更明确的变量替换方式
-    prompt = ChatPromptTemplate.from_template(
-    f"""
+# 审核提示模板：{code} 和 {rag_report} 是真正的模板变量，用户代码里的花括号不会再破坏模板
+REVIEW_TEMPLATE = """
     你是一位严厉但公正的资深 Python 代码审查专家。
         
         我会给你一段代码，以及一个“RAG规则匹配报告”。请注意：这个报告是基于严格规则自动生成的，**可能包含一些“误报”**（即技术上违规，但在当前语境下其实无害）。
@@ -66,24 +61,445 @@ def ai_code_review(code: str, rag_report: str):
         
         请直接给出你的审查意见。
     """
+
+# 模板只编译一次，所有审核共用
+REVIEW_PROMPT = ChatPromptTemplate.from_template(REVIEW_TEMPLATE)
+
+# 大文件分块审核后，把各块的意见合并成一份
+REDUCE_TEMPLATE = """
+    你是一位严厉但公正的资深 Python 代码审查专家。
+        
+        同一个文件太大，被分成几块分别审查，下面是每一块的审查意见。
+        请把它们合并成一份完整的审查意见：去掉重复的内容，只保留真正严重的问题，
+        不要用列表、表格或编号，用聊天的口吻直接告诉我哪里有问题，为什么不行，怎么改。
+        
+        分块审查意见：
+        {reviews}
+        
+        请直接给出合并后的审查意见。
+    """
+
+REDUCE_PROMPT = ChatPromptTemplate.from_template(REDUCE_TEMPLATE)
+
+# 批量审核：几个小文件放进同一个请求，固定的审查要求只需要预填充一次
+BATCH_TEMPLATE = """
+    你是一位严厉但公正的资深 Python 代码审查专家。
+        
+        我会给你几个文件，每个文件都有代码和一个“RAG规则匹配报告”。请注意：这些报告是基于严格规则自动生成的，**可能包含一些“误报”**（即技术上违规，但在当前语境下其实无害）。
+        
+        你的核心任务是：
+        1. 【智能过滤】（最重要）：请结合代码逻辑判断。
+           - 如果某个“违规”是无伤大雅的（例如 if 中的简单 print、非高频操作），请直接忽略，不要在回答中提及。
+           - 不要为了凑数而指出小问题。
+        2. 【直击痛点】：重点指出那些真正的严重问题（例如循环中连接数据库、安全隐患、严重性能瓶颈）。
+        3. 【自然表达】：不要用列表、表格或“1. 2. 3.”这种编号。用聊天的口吻，直接告诉我哪里有问题，为什么不行，怎么改。
+        4. 【分文件回答】：每个文件的意见单独成段，段首原样写出该文件的标题行（例如“### 文件 1”），不要合并不同文件的意见，也不要遗漏文件。
+        
+        {files}
+        
+        请按文件顺序给出审查意见。
+    """
+
+BATCH_PROMPT = ChatPromptTemplate.from_template(BATCH_TEMPLATE)
+
+# 批量回答里每个文件意见的标题行
+_BATCH_HEADER = re.compile(r"^[ \t]*#{1,6}[ \t]*文件[ \t]*(\d+)[^\n]*$", re.MULTILINE)
+
+def format_batch(files: list) -> str:
+    """
+    把 [(文件名, 代码, 违规列表)] 拼成批量提示里的文件部分，文件按 1、2、3 编号
+    """
+    parts = []
+    for n, (name, code, violations) in enumerate(files, 1):
+        parts.append(f"### 文件 {n}: {name}\n代码：\n{code}\n\nRAG规则匹配报告：\n{format_report(violations)}")
+    return "\n\n".join(parts)
+
+def split_batch_response(response: str, count: int) -> dict:
+    """
+    按标题行把批量回答切回每个文件，返回 {编号: 审查意见}
+    模型漏掉或编错号的文件不会出现在结果里
+    """
+    reviews = {}
+    matches = list(_BATCH_HEADER.finditer(response))
+    for m, next_m in zip(matches, matches[1:] + [None]):
+        n = int(m.group(1))
+        body = response[m.end():next_m.start() if next_m else len(response)].strip()
+        if 1 <= n <= count and body and n not in reviews:
+            reviews[n] = body
+    return reviews
+
+# 模型在 Ollama 服务端的常驻时间，两次请求之间不会被卸载
+REVIEW_KEEP_ALIVE = "30m"
+# 模型上下文窗口：代码和报告的预算（ctxde1.DEFAULT_TOKEN_BUDGET）+ 提示模板 + 回答
+REVIEW_NUM_CTX = 8192
+
+# 创建AI模型客户端
+def create_model(deterministic: bool = False, keep_alive=REVIEW_KEEP_ALIVE):
+    """
+    deterministic=True 时使用 temperature=0 和固定 seed，相同输入得到相同回答
+    keep_alive 让 Ollama 在空闲时也保持模型加载
+    """
+    if deterministic:
+        return ChatOllama(
+            model=REVIEW_MODEL,
+            temperature=0,
+            seed=REVIEW_SEED,
+            num_ctx=REVIEW_NUM_CTX,
+            keep_alive=keep_alive
+        )
+    return ChatOllama(
+        model=REVIEW_MODEL,
+        temperature=1.0,
+        num_ctx=REVIEW_NUM_CTX,
+        keep_alive=keep_alive
     )
-    
-    # 创建输出解析器
-    output_parser = StrOutputParser()
-    
-    # 构建链
-    chain = prompt | model | output_parser
-    
-    # 执行AI审核
-    response = chain.invoke({
-        "code": code,
-        "rag_report": rag_report
-    })
-    
+
+# 句子结束符，按句输出时在这些字符后切分
+_SENTENCE_ENDS = "。！？!?\n"
+
+def _take_sentences(buffer: str):
+    """
+    从缓冲区里切出已经完整的句子，返回 (完整句子列表, 剩余部分)
+    """
+    sentences = []
+    start = 0
+    for i, ch in enumerate(buffer):
+        if ch in _SENTENCE_ENDS:
+            sentences.append(buffer[start:i + 1])
+            start = i + 1
+    return sentences, buffer[start:]
+
+def _sentence_chunks(chunks):
+    buffer = ""
+    for chunk in chunks:
+        sentences, buffer = _take_sentences(buffer + chunk)
+        yield from sentences
+    if buffer:
+        yield buffer
+
+async def _asentence_chunks(chunks):
+    buffer = ""
+    async for chunk in chunks:
+        sentences, buffer = _take_sentences(buffer + chunk)
+        for sentence in sentences:
+            yield sentence
+    if buffer:
+        yield buffer
+
+class UsageCallback(BaseCallbackHandler):
+    """
+    每次模型调用结束时，把 token 用量和 Ollama 报告的各阶段耗时记到 perfde1.METRICS
+    （流式调用结束时拿到的是拼好的完整消息，同样有用量信息）
+    """
+    # Ollama response_metadata 里的耗时字段（纳秒） -> 阶段名
+    _DURATIONS = (("load_duration", "llm.load"), ("prompt_eval_duration", "llm.prefill"),
+                  ("eval_duration", "llm.decode"))
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or {}
+                perfde1.incr("llm.calls")
+                perfde1.incr("llm.prompt_tokens", usage.get("input_tokens", 0))
+                perfde1.incr("llm.completion_tokens", usage.get("output_tokens", 0))
+                metadata = getattr(message, "response_metadata", None) or {}
+                for key, name in self._DURATIONS:
+                    if metadata.get(key):
+                        perfde1.METRICS.observe(name, metadata[key] / 1e9)
+
+USAGE_CALLBACK = UsageCallback()
+
+class Reviewer:
+    """
+    可复用的审核器：持有一个 ChatOllama 客户端（它内部的 HTTP 连接池随之复用）、
+    预编译的提示模板和组装好的审核链，每次审核只需要填入变量
+    """
+    def __init__(self, model=None, deterministic: bool = False) -> None:
+        self.model = model if model is not None else create_model(deterministic)
+        self.model_name = getattr(self.model, "model", type(self.model).__name__)
+        # 构建链，模型调用都挂上用量统计
+        llm = self.model.with_config(callbacks=[USAGE_CALLBACK])
+        self.chain = REVIEW_PROMPT | llm | StrOutputParser()
+        self.reduce_chain = REDUCE_PROMPT | llm | StrOutputParser()
+        self.batch_chain = BATCH_PROMPT | llm | StrOutputParser()
+
+    @perfde1.timed("llm.warm_up")
+    def warm_up(self) -> None:
+        """
+        发一个很短的请求，让 Ollama 提前把模型加载进显存 / 内存，第一条审核不用再等模型加载
+        只生成一个 token（num_predict=1），不让模型真的写完一段回答；
+        其他参数（num_ctx、keep_alive 等）不变，否则 Ollama 会按新参数重新加载模型
+        """
+        model = self.model
+        if hasattr(model, "num_predict"):
+            model = model.model_copy(update={"num_predict": 1})
+        model.invoke("ping")
+
+    @perfde1.timed("llm.review")
+    def review(self, code: str, rag_report: str) -> str:
+        return self.chain.invoke({"code": code, "rag_report": rag_report})
+
+    @perfde1.timed("llm.review")
+    async def areview(self, code: str, rag_report: str) -> str:
+        return await self.chain.ainvoke({"code": code, "rag_report": rag_report})
+
+    @perfde1.timed("llm.review_file")
+    def review_file(self, code: str, violations: list, budget: int = ctxde1.DEFAULT_TOKEN_BUDGET) -> str:
+        """
+        按 token 预算审核整个文件：放得下时和 review 一样；
+        放不下时只发含违规的函数，还放不下就逐块审核再合并（map-reduce）
+        """
+        chunks = ctxde1.pack_context(code, violations, budget)
+        reviews = [self.review(chunk["code"], format_report(chunk["violations"])) for chunk in chunks]
+        while len(reviews) > 1:
+            reviews = [self.reduce_chain.invoke({"reviews": group}) for group in _group_reviews(reviews, budget)]
+        return reviews[0]
+
+    @perfde1.timed("llm.review_file")
+    async def areview_file(self, code: str, violations: list, budget: int = ctxde1.DEFAULT_TOKEN_BUDGET,
+                           limits: "CallLimits" = None) -> str:
+        """
+        异步版本的 review_file，各块并发审核
+        limits: 调用方的并发、超时和重试限制，每次模型调用单独占名额、单独超时重试（调度器传入）；
+        某一块失败重试时，已经完成的块不会重新审核
+        """
+        chunks = ctxde1.pack_context(code, violations, budget)
+        reviews = await asyncio.gather(*(
+            _limited(limits, lambda chunk=chunk: self.areview(chunk["code"], format_report(chunk["violations"])))
+            for chunk in chunks))
+        while len(reviews) > 1:
+            reviews = await asyncio.gather(*(
+                _limited(limits, lambda group=group: self.reduce_chain.ainvoke({"reviews": group}))
+                for group in _group_reviews(reviews, budget)))
+        return reviews[0]
+
+    @perfde1.timed("llm.review_batch")
+    def review_batch(self, files: list, budget: int = ctxde1.DEFAULT_TOKEN_BUDGET) -> list:
+        """
+        批量审核多个文件，files: [(文件名, 代码, 违规列表)]，返回和 files 顺序一致的审查意见列表
+        小文件按 token 预算打包进同一个请求，回答按文件标题切回去；
+        大文件、以及模型回答里缺失的文件，单独走 review_file
+        """
+        reviews = [None] * len(files)
+        costs = [ctxde1.file_tokens(code, violations) for _, code, violations in files]
+        for batch in ctxde1.pack_batches(costs, budget):
+            parts = {}
+            if len(batch) > 1:
+                response = self.batch_chain.invoke({"files": format_batch([files[i] for i in batch])})
+                parts = split_batch_response(response, len(batch))
+            for n, i in enumerate(batch, 1):
+                reviews[i] = parts.get(n) or self.review_file(files[i][1], files[i][2], budget)
+        return reviews
+
+    @perfde1.timed("llm.review_batch")
+    async def areview_batch(self, files: list, budget: int = ctxde1.DEFAULT_TOKEN_BUDGET,
+                            limits: "CallLimits" = None) -> list:
+        """
+        异步版本的 review_batch，各批并发审核；limits 和 areview_file 一样，
+        一个批量请求要生成好几个文件的意见，它的超时按文件数放宽
+        """
+        reviews = [None] * len(files)
+        costs = [ctxde1.file_tokens(code, violations) for _, code, violations in files]
+
+        async def run(batch):
+            parts = {}
+            if len(batch) > 1:
+                response = await _limited(
+                    limits, lambda: self.batch_chain.ainvoke({"files": format_batch([files[i] for i in batch])}),
+                    len(batch))
+                parts = split_batch_response(response, len(batch))
+            for n, i in enumerate(batch, 1):
+                reviews[i] = parts.get(n) or await self.areview_file(files[i][1], files[i][2], budget, limits)
+
+        await asyncio.gather(*(run(batch) for batch in ctxde1.pack_batches(costs, budget)))
+        return reviews
+
+    def stream(self, code: str, rag_report: str, by_sentence: bool = False):
+        chunks = self.chain.stream({"code": code, "rag_report": rag_report})
+        if by_sentence:
+            chunks = _sentence_chunks(chunks)
+        with perfde1.stage("llm.stream"):
+            yield from chunks
+
+    async def astream(self, code: str, rag_report: str, by_sentence: bool = False):
+        chunks = self.chain.astream({"code": code, "rag_report": rag_report})
+        if by_sentence:
+            chunks = _asentence_chunks(chunks)
+        with perfde1.stage("llm.stream"):
+            async for chunk in chunks:
+                yield chunk
+
+class CallLimits:
+    """
+    异步审核时每次模型调用的限制
+    - slots: 共享的并发名额（asyncio.Semaphore），None 表示不限制
+    - timeout: 单次调用的超时（秒），占到名额之后才开始计时，None 表示不限制
+    - retries / backoff: 失败后最多重试的次数、第一次重试前等待的秒数（之后每次翻倍，加随机抖动）
+    重试前的等待不占名额；attempts 记录单次调用用到的最多尝试次数
+    """
+    def __init__(self, slots: asyncio.Semaphore = None, timeout: float = None, retries: int = 0,
+                 backoff: float = 1.0) -> None:
+        self.slots = slots
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.attempts = 0
+
+    async def call(self, make_call, scale: int = 1):
+        """
+        make_call: 每次尝试都新建一个协程的函数；scale: 超时放宽的倍数
+        重试次数用完后抛出最后一次的异常
+        """
+        timeout = None if self.timeout is None else self.timeout * scale
+        for attempt in range(self.retries + 1):
+            self.attempts = max(self.attempts, attempt + 1)
+            try:
+                if self.slots is None:
+                    return await asyncio.wait_for(make_call(), timeout)
+                async with self.slots:
+                    return await asyncio.wait_for(make_call(), timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random() * 0.1))
+
+async def _limited(limits: CallLimits, make_call, scale: int = 1):
+    """
+    按 limits 执行一次模型调用（limits 为 None 时直接调用，不限制）
+    """
+    if limits is None:
+        return await make_call()
+    return await limits.call(make_call, scale)
+
+def _group_reviews(reviews: list, budget: int) -> list:
+    """
+    把分块意见按预算分组，每组拼成一段交给合并链；
+    每组至少两段，保证每一轮合并后段数都会减少
+    """
+    groups = []
+    current, used = [], 0
+    for review in reviews:
+        cost = ctxde1.estimate_tokens(review)
+        if len(current) >= 2 and used + cost > budget:
+            groups.append(current)
+            current, used = [], 0
+        current.append(review)
+        used += cost
+    if len(current) == 1 and groups:
+        groups[-1].append(current[0])
+    else:
+        groups.append(current)
+    return ["\n\n".join(f"【第 {i} 块】\n{review}" for i, review in enumerate(group, 1)) for group in groups]
+
+_reviewers = {}  # deterministic -> 进程里共享的 Reviewer
+_reviewers_lock = threading.Lock()
+
+def get_reviewer(deterministic: bool = False) -> Reviewer:
+    """
+    返回进程里共享的审核器，第一次调用时创建
+    """
+    with _reviewers_lock:
+        reviewer = _reviewers.get(deterministic)
+        if reviewer is None:
+            reviewer = _reviewers[deterministic] = Reviewer(deterministic=deterministic)
+        return reviewer
+
+def as_reviewer(model=None) -> Reviewer:
+    """
+    model 可以是 None（用共享审核器）、Reviewer，或者任意 LangChain 聊天模型
+    """
+    if model is None:
+        return get_reviewer()
+    if isinstance(model, Reviewer):
+        return model
+    return Reviewer(model)
+
+# 构建AI审核链
+def build_review_chain(model=None):
+    """
+    返回 prompt | model | StrOutputParser 审核链
+    """
+    return as_reviewer(model).chain
+
+# 定义AI审核函数
+def ai_code_review(code: str, rag_report: str, model=None):
+    """
+    使用AI模型对代码进行智能审核
+    参数：
+    - code: 要审查的代码
+    - rag_report: RAG规则匹配生成的报告
+    - model: 可选，Reviewer 或已经创建好的模型客户端，默认用进程里共享的审核器
+    """
+    return as_reviewer(model).review(code, rag_report)
+
+# 异步AI审核
+async def ai_code_review_async(code: str, rag_report: str, model=None):
+    """
+    异步版本的 ai_code_review，用 ainvoke 调用模型，多个审核可以并发
+    """
+    return await as_reviewer(model).areview(code, rag_report)
+
+# 批量AI审核
+def ai_code_review_batch(files: list, model=None):
+    """
+    把几个小文件放进同一个请求审核，files: [(文件名, 代码, 违规列表)]
+    返回和 files 顺序一致的审查意见列表
+    """
+    return as_reviewer(model).review_batch(files)
+
+# 计算LLM回答缓存的键
+def review_cache_key(code: str, violations: list, model_name: str) -> str:
+    """
+    缓存键 = 哈希(规范化 AST, 违规集合, 提示模板版本, 模型名)
+    只改了格式或注释的代码、以及顺序不同的同一组违规，都会得到同一个键
+    """
+    violation_set = sorted(
+        (astde1.normalized_hash(v["code"]) if v.get("code") else "", v.get("context", ""), v["severity"], v["rule"])
+        for v in violations
+    )
+    payload = json.dumps([astde1.normalized_hash(code), violation_set, PROMPT_VERSION, model_name],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# 带缓存的确定性AI审核
+def cached_ai_code_review(code: str, violations: list, model=None, cache: cachede1.LLMResponseCache = None):
+    """
+    确定性审核 + 持久回答缓存：没改过的代码再次审核时直接返回上次的回答，不再调用模型
+    model 不传时使用共享的确定性审核器，cache 不传时使用进程里共享的默认回答缓存
+    """
+    reviewer = get_reviewer(deterministic=True) if model is None else as_reviewer(model)
+    if cache is None:
+        cache = cachede1.get_llm_cache()
+    key = review_cache_key(code, violations, reviewer.model_name)
+    response = cache.get(key)
+    if response is None:
+        response = reviewer.review_file(code, violations)
+        cache.put(key, reviewer.model_name, response)
     return response
 
+# 流式AI审核
+def ai_code_review_stream(code: str, rag_report: str, model=None, by_sentence: bool = False):
+    """
+    流式版本的 ai_code_review：模型每生成一段就立刻产出，不用等整段回答结束
+    by_sentence=True 时攒够一句再产出
+    """
+    yield from as_reviewer(model).stream(code, rag_report, by_sentence)
+
+# 异步流式AI审核
+async def ai_code_review_astream(code: str, rag_report: str, model=None, by_sentence: bool = False):
+    """
+    异步流式版本的 ai_code_review，参数同 ai_code_review_stream
+    """
+    async for chunk in as_reviewer(model).astream(code, rag_report, by_sentence):
+        yield chunk
+
 # 主函数
 if __name__ == "__main__":
+    # 日志级别由环境变量 CODEREVIEW_LOG 控制：quiet / summary（默认）/ trace
+    logde1.configure()
     
     print("🚀 AI代码审查工具已启动...")
     print("=" * 60)
@@ -108,24 +524,34 @@ def process_data(items):
     try:
         # 1. RAG规则匹配
         print("第一步：RAG规则匹配")
-        rag_report = query(test_code)
+        calls = astde1.extract_calls(test_code)
+        violations = ragde1.get_rule_store().check(calls)
+        rag_report = format_report(violations)
         print(rag_report)
         
-        # 2. AI智能审核
-        print("\n" + "=" * 60)
-        print("第二步：AI智能审核")
-        print("正在调用AI模型...")
-        ai_result = ai_code_review(test_code, rag_report)
-        
-        # 3. 输出最终结果
+        # 2. 分诊：RAG 没发现值得复核的问题时不调用模型
         print("\n" + "=" * 60)
-        print("🤖 AI最终审核结果:")
-        print("=" * 60)
-        print(ai_result)
+        print("第二步：分诊")
+        decision = triagede1.triage(test_code, violations, calls)
+        if not decision["needed"]:
+            print("✅ 没有需要 AI 复核的问题，跳过 AI 审核")
+        else:
+            print(f"需要 AI 复核: {'；'.join(decision['reasons'])}")
+            
+            # 3. AI智能审核：RAG 报告已经先打印出来了，AI 的回答边生成边输出
+            print("\n" + "=" * 60)
+            print("第三步：AI智能审核")
+            print("🤖 AI审核结果:")
+            print("=" * 60)
+            for chunk in ai_code_review_stream(test_code, rag_report):
+                print(chunk, end="", flush=True)
+            print()
         
     except Exception as e:
         print(f"❌ 运行出错: {e}")
         import traceback
         traceback.print_exc()
     print("\n" + "=" * 60)
+    print("📈 各阶段耗时和计数:")
+    print(perfde1.METRICS.to_json())
     print("over")
\ No newline at end of file
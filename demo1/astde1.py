@@ -1,39 +1,432 @@
 import ast
+import hashlib
+import re
+from array import array
+from collections.abc import Mapping, Sequence
 from doctest import FAIL_FAST
-def analyze_code(code:str)->list:
-    class CodeAnalyzer(ast.NodeVisitor):
-        def __init__(self) -> None:
-            self.results=[]
-            self.in_loop=False
-            self.in_if=False
-            self.loop_stack=[]
-            self.if_stack=[]
-        def visit(self,node):
-            node_info={
-                "type":type(node).__name__,
-                "in_loop":self.in_loop,
-                "in_if":self.in_if,
-                "code":ast.get_source_segment(code,node) if hasattr(node,'lineno') else None
-            }
-            self.results.append(node_info)
-            if isinstance(node,(ast.For,ast.While,ast.AsyncFor)):
-                self.loop_stack.append(node)
-                self.in_loop=True
-            if isinstance(node,ast.If):
-                self.if_stack.append(node)
-                self.in_if=True
-            super().visit(node)
-            if isinstance(node, (ast.For, ast.While, ast.AsyncFor)):
-                self.loop_stack.pop()
-                self.in_loop = len(self.loop_stack) > 0
-            
-            if isinstance(node, ast.If):
-                self.if_stack.pop()
-                self.in_if = len(self.if_stack) > 0
-    tree=ast.parse(code)
-    analyze=CodeAnalyzer()
-    analyze.visit(tree)
-    return analyze.results        
+
+import perfde1
+
+# 分析器版本：调用点抽取逻辑有变化时递增，让增量缓存里的旧分析结果失效
+ANALYZER_VERSION = "1"
+
+# 节点类型编号表：类型 -> type id，以及 type id -> 类型名
+_TYPE_IDS = {}
+_TYPE_NAMES = []
+
+# 标志位：节点是否在循环 / if 中
+FLAG_IN_LOOP = 1
+FLAG_IN_IF = 2
+
+_LOOP_TYPES = (ast.For, ast.While, ast.AsyncFor)
+_LINE_BREAK = re.compile(rb"\r\n|\r|\n")
+
+
+def _type_id(node_type) -> int:
+    tid = _TYPE_IDS.get(node_type)
+    if tid is None:
+        tid = len(_TYPE_NAMES)
+        _TYPE_IDS[node_type] = tid
+        _TYPE_NAMES.append(node_type.__name__)
+    return tid
+
+
+class _SourceText:
+    """
+    源码切片器：第一次切片时才把源码编码成 UTF-8 并记录每行起始偏移
+    （col_offset 是 UTF-8 字节偏移，所以在字节串上切）
+    """
+    __slots__ = ("code", "_code_bytes", "_line_starts")
+
+    def __init__(self, code: str) -> None:
+        self.code = code
+        self._code_bytes = None
+        self._line_starts = None
+
+    def segment(self, lineno: int, col_offset: int, end_lineno: int, end_col_offset: int) -> str:
+        if self._line_starts is None:
+            self._code_bytes = self.code.encode("utf-8")
+            self._line_starts = [0] + [m.end() for m in _LINE_BREAK.finditer(self._code_bytes)]
+        start = self._line_starts[lineno - 1] + col_offset
+        end = self._line_starts[end_lineno - 1] + end_col_offset
+        return self._code_bytes[start:end].decode("utf-8")
+
+
+class NodeTable:
+    """
+    紧凑的节点表（struct-of-arrays）
+    每个 AST 节点只在各个数组里占一个槽位，不再为每个节点建一个 dict；
+    代码片段只有在真正被读取时才从源码里切出来
+    """
+    __slots__ = ("code", "nodes", "type_ids", "flags", "lineno", "col_offset",
+                 "end_lineno", "end_col_offset", "parent", "source")
+
+    def __init__(self, code: str) -> None:
+        self.code = code
+        self.source = _SourceText(code)   # source: 按需切片用的源码
+        self.nodes = []                   # nodes: 原始 AST 节点，规则需要细看时再用
+        self.type_ids = array("H")        # type_ids: 节点类型编号，对应 _TYPE_NAMES
+        self.flags = array("B")           # flags: FLAG_IN_LOOP / FLAG_IN_IF 组合
+        self.lineno = array("i")          # 位置信息，没有位置的节点记为 -1
+        self.col_offset = array("i")
+        self.end_lineno = array("i")
+        self.end_col_offset = array("i")
+        self.parent = array("i")          # parent: 父节点下标，根节点为 -1
+
+    def __len__(self) -> int:
+        return len(self.type_ids)
+
+    def append(self, node, parent: int, flags: int) -> int:
+        index = len(self.type_ids)
+        self.nodes.append(node)
+        self.type_ids.append(_type_id(type(node)))
+        self.flags.append(flags)
+        lineno = getattr(node, "lineno", None)
+        end_lineno = getattr(node, "end_lineno", None)
+        if lineno is None or end_lineno is None:
+            self.lineno.append(-1)
+            self.col_offset.append(-1)
+            self.end_lineno.append(-1)
+            self.end_col_offset.append(-1)
+        else:
+            self.lineno.append(lineno)
+            self.col_offset.append(node.col_offset)
+            self.end_lineno.append(end_lineno)
+            self.end_col_offset.append(node.end_col_offset)
+        self.parent.append(parent)
+        return index
+
+    def type_name(self, index: int) -> str:
+        return _TYPE_NAMES[self.type_ids[index]]
+
+    def in_loop(self, index: int) -> bool:
+        return bool(self.flags[index] & FLAG_IN_LOOP)
+
+    def in_if(self, index: int) -> bool:
+        return bool(self.flags[index] & FLAG_IN_IF)
+
+    def segment(self, index: int):
+        """
+        按需切出节点对应的源码，结果与 ast.get_source_segment 一致
+        """
+        if self.lineno[index] < 0:
+            return None
+        return self.source.segment(self.lineno[index], self.col_offset[index],
+                                   self.end_lineno[index], self.end_col_offset[index])
+
+    def results(self) -> "NodeView":
+        return NodeView(self)
+
+
+class NodeRecord(Mapping):
+    """
+    兼容旧格式的单条结果：{"type", "in_loop", "in_if", "code"}
+    只在读取对应的键时才去节点表里取值
+    """
+    __slots__ = ("_table", "_index")
+    _KEYS = ("type", "in_loop", "in_if", "code")
+
+    def __init__(self, table: NodeTable, index: int) -> None:
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, key):
+        if key == "type":
+            return self._table.type_name(self._index)
+        if key == "in_loop":
+            return self._table.in_loop(self._index)
+        if key == "in_if":
+            return self._table.in_if(self._index)
+        if key == "code":
+            return self._table.segment(self._index)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self) -> int:
+        return len(self._KEYS)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class NodeView(Sequence):
+    """
+    节点表的惰性列表视图，print_analysis 和 ragde1.rag_check 可以照旧按 list of dict 使用
+    """
+    __slots__ = ("table",)
+
+    def __init__(self, table: NodeTable) -> None:
+        self.table = table
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [NodeRecord(self.table, i) for i in range(len(self.table))[index]]
+        if index < 0:
+            index += len(self.table)
+        if not 0 <= index < len(self.table):
+            raise IndexError(index)
+        return NodeRecord(self.table, index)
+
+
+def parse_code(code: str) -> ast.Module:
+    """
+    解析源码（计入 ast.parse 阶段），结果可以传给 build_node_table / analyze_code / extract_calls 的 tree 参数，
+    多个分析共用一棵语法树；代码有语法错误时抛出 SyntaxError
+    """
+    with perfde1.stage("ast.parse"):
+        return ast.parse(code)
+
+
+@perfde1.timed("ast.analyze")
+def build_node_table(code: str, tree: ast.Module = None) -> NodeTable:
+    """
+    单次遍历生成紧凑节点表，节点顺序与 ast.NodeVisitor 的前序遍历相同
+    in_loop / in_if 由父节点直接推出来，不需要维护 loop_stack / if_stack
+    tree: 已经解析好的 code 的语法树，不传时现场解析
+    """
+    table = NodeTable(code)
+    # stack: 待访问的 (节点, 父节点下标, 标志位)
+    stack = [(tree if tree is not None else parse_code(code), -1, 0)]
+    while stack:
+        node, parent, flags = stack.pop()
+        index = table.append(node, parent, flags)
+        child_flags = flags
+        if isinstance(node, _LOOP_TYPES):
+            child_flags |= FLAG_IN_LOOP
+        if isinstance(node, ast.If):
+            child_flags |= FLAG_IN_IF
+        children = list(ast.iter_child_nodes(node))
+        for child in reversed(children):
+            stack.append((child, index, child_flags))
+    return table
+
+
+def analyze_code(code:str, compact:bool=False, tree:ast.Module=None):
+    """
+    分析代码结构
+    compact=False 时返回兼容旧格式的惰性视图（可以当 list of dict 用）；
+    compact=True 时直接返回 NodeTable
+    tree: 已经解析好的语法树（同一份代码还要 extract_calls 时可以只解析一次）
+    """
+    table = build_node_table(code, tree)
+    if compact:
+        return table
+    return table.results()
+
+
+# 会改变调用环境的控制结构：节点类型 -> 环境名
+_CONTEXT_KINDS = {ast.For: "For", ast.While: "While", ast.AsyncFor: "AsyncFor", ast.If: "If"}
+_LOOP_KINDS = ("For", "While", "AsyncFor")
+_FUNCTION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def _dotted_name(func):
+    """
+    解析调用目标的点分名称
+    例如: print -> "print", db.conn.connect -> "db.conn.connect"
+    get_db().connect 这类基底不是名字的调用返回 None
+    """
+    parts = []
+    while isinstance(func, ast.Attribute):
+        parts.append(func.attr)
+        func = func.value
+    if not isinstance(func, ast.Name):
+        return None
+    parts.append(func.id)
+    return ".".join(reversed(parts))
+
+
+def call_name(node: ast.Call) -> tuple:
+    """
+    调用的 (点分名称, 动作名)
+    例如: db.connect() -> ("db.connect", "connect")，get_db().connect() -> (None, "connect")，
+    f()() 这类连动作名都没有的调用 -> (None, "unknown")
+    """
+    name = _dotted_name(node.func)
+    if name is not None:
+        return name, name.rpartition(".")[2]
+    if isinstance(node.func, ast.Attribute):
+        return None, node.func.attr
+    return None, "unknown"
+
+
+class CallSite:
+    """
+    单个调用点：点分名称、动作名、位置、所处的 loop/if 环境栈和所在函数
+    """
+    __slots__ = ("name", "action", "lineno", "col_offset", "end_lineno", "end_col_offset",
+                 "context", "function", "_source")
+
+    def __init__(self, name, action, node, context, function, source) -> None:
+        self.name = name                  # name: 点分名称，如 db.connect，解析不了时为 None
+        self.action = action              # action: 动作名，即名称最后一段，如 connect
+        self.lineno = node.lineno
+        self.col_offset = node.col_offset
+        self.end_lineno = node.end_lineno
+        self.end_col_offset = node.end_col_offset
+        self.context = context            # context: 外层控制结构，从外到内，如 ("If", "For")
+        self.function = function          # function: 所在函数的限定名，模块级为 None
+        self._source = source
+
+    @property
+    def code(self) -> str:
+        return self._source.segment(self.lineno, self.col_offset, self.end_lineno, self.end_col_offset)
+
+    @property
+    def loop_depth(self) -> int:
+        return sum(1 for kind in self.context if kind in _LOOP_KINDS)
+
+    @property
+    def if_depth(self) -> int:
+        return self.context.count("If")
+
+    @property
+    def in_loop(self) -> bool:
+        return self.loop_depth > 0
+
+    @property
+    def in_if(self) -> bool:
+        return "If" in self.context
+
+    def to_dict(self) -> dict:
+        """
+        可序列化的调用点记录，兼容 analyze_code 的 dict 格式（type / code / in_loop / in_if）
+        """
+        return {
+            "type": "Call",
+            "name": self.name,
+            "action": self.action,
+            "code": self.code,
+            "in_loop": self.in_loop,
+            "in_if": self.in_if,
+            "context": list(self.context),
+            "function": self.function,
+            "lineno": self.lineno,
+            "col_offset": self.col_offset,
+            "end_lineno": self.end_lineno,
+            "end_col_offset": self.end_col_offset,
+        }
+
+    def __repr__(self) -> str:
+        return f"CallSite({self.name or self.action!r}, line={self.lineno}, context={self.context}, function={self.function!r})"
+
+
+# 环境栈 -> 倒排索引的键，环境栈的组合很少，算一次记下来
+_CONTEXT_KEYS = {}
+
+
+def _context_keys(context: tuple) -> tuple:
+    keys = _CONTEXT_KEYS.get(context)
+    if keys is None:
+        keys = set(context)
+        if any(kind in _LOOP_KINDS for kind in context):
+            keys.add("loop")
+        if "If" in context:
+            keys.add("if")
+        if not keys:
+            keys.add("anywhere")
+        keys = _CONTEXT_KEYS[context] = tuple(sorted(keys))
+    return keys
+
+
+class CallIndex:
+    """
+    调用点列表 + 按环境 / 按动作的倒排索引
+    例如 index.under("While") 直接拿到所有在 while 里的调用，不用线性扫描
+    环境键: For / While / AsyncFor / If，汇总键 loop / if，以及不在任何结构里的 anywhere
+    """
+    __slots__ = ("calls", "by_context", "by_action")
+
+    def __init__(self) -> None:
+        self.calls = []
+        self.by_context = {}
+        self.by_action = {}
+
+    def add(self, site: CallSite) -> None:
+        index = len(self.calls)
+        self.calls.append(site)
+        for key in _context_keys(site.context):
+            self.by_context.setdefault(key, []).append(index)
+        self.by_action.setdefault(site.action, []).append(index)
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def __iter__(self):
+        return iter(self.calls)
+
+    def __getitem__(self, index):
+        return self.calls[index]
+
+    def under(self, kind: str) -> list:
+        return [self.calls[i] for i in self.by_context.get(kind, ())]
+
+    def named(self, action: str) -> list:
+        return [self.calls[i] for i in self.by_action.get(action, ())]
+
+
+# 调用点抽取后端：ast 用标准库，代码有语法错误时抛 SyntaxError；
+# tree_sitter 见 tsde1，能分析有语法错误的代码，需要安装 tree-sitter-python
+BACKENDS = ("ast", "tree_sitter")
+
+
+def extract_calls(code: str, backend: str = "ast", tree: ast.Module = None) -> CallIndex:
+    """
+    抽取调用点，两个后端给出的记录格式和环境判断相同
+    tree: ast 后端可以传入已经解析好的语法树
+    """
+    if backend == "tree_sitter":
+        import tsde1
+        return tsde1.extract_calls(code)
+    return _extract_calls_ast(code, tree)
+
+
+@perfde1.timed("ast.extract_calls")
+def _extract_calls_ast(code: str, tree: ast.Module = None) -> CallIndex:
+    """
+    只抽取调用点的分析路径，不为 Name / Load / Constant 等节点分配任何记录
+    环境判断与 analyze_code 一致：loop/if 节点下的所有后代都算在该环境中
+    """
+    source = _SourceText(code)
+    index = CallIndex()
+    # stack: 待访问的 (节点, 环境栈, 所在函数, 限定名前缀)
+    stack = [(tree if tree is not None else parse_code(code), (), None, "")]
+    while stack:
+        node, context, function, prefix = stack.pop()
+        if isinstance(node, ast.Call):
+            name, action = call_name(node)
+            index.add(CallSite(name, action, node, context, function, source))
+        kind = _CONTEXT_KINDS.get(type(node))
+        if kind is not None:
+            context = context + (kind,)
+        if isinstance(node, _FUNCTION_TYPES):
+            function = prefix + node.name
+            prefix = function + "."
+        elif isinstance(node, ast.ClassDef):
+            prefix = prefix + node.name + "."
+        children = list(ast.iter_child_nodes(node))
+        for child in reversed(children):
+            stack.append((child, context, function, prefix))
+    return index
+
+
+def normalized_hash(code: str) -> str:
+    """
+    代码的规范化哈希：基于不带位置信息的 AST dump，空白、注释、换行风格的改动都不影响结果
+    代码无法解析时退化为按行去掉首尾空白后的文本哈希
+    """
+    try:
+        text = ast.dump(ast.parse(code), annotate_fields=False, include_attributes=False)
+    except SyntaxError:
+        text = "\n".join(line.strip() for line in code.splitlines() if line.strip())
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
 def print_analysis(results):
     """
     打印分析结果
@@ -0,0 +1,441 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import astde1
+import rulede1
+import walkde1
+
+# 默认的语料规模（行数）
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+# 比较两次运行时，p50 延迟变慢超过这个比例就算性能回退
+DEFAULT_THRESHOLD = 0.10
+
+# 基准用的规则：和 init_rag_db 的默认规则一样，再加一条循环里的语义规则，让向量检索路径也跑起来
+BENCH_RULES = [
+    ("rule_no_print_in_loop", "禁止在循环中使用 print 语句，这会严重影响性能并导致日志刷屏。",
+     {"action": "print", "forbidden_in": "loop", "severity": "low"}),
+    ("rule_no_connect_in_loop", "禁止在循环中创建数据库连接，应该使用连接池或在循环外连接。",
+     {"action": "connect", "forbidden_in": "loop", "severity": "high"}),
+    ("rule_no_print_in_if", "禁止在 if 语句中使用 print，建议用日志框架替代。",
+     {"action": "print", "forbidden_in": "if", "severity": "low"}),
+    ("rule_no_eval_in_if", "禁止在 if 条件分支中使用 eval() 函数，存在严重安全风险。",
+     {"action": "eval", "forbidden_in": "if", "severity": "high"}),
+    ("rule_no_query_in_loop", "避免在循环里逐条执行 SQL 查询，应该批量查询。",
+     {"action": "execute", "forbidden_in": "loop", "severity": "medium", "match": "semantic"}),
+]
+
+# 生成代码时用到的调用语句
+_CALLS = [
+    'print(f"item {i}")',
+    "db.connect()",
+    'cursor.execute("SELECT * FROM t WHERE id = %s", (i,))',
+    "helper(i)",
+    "eval(expr)",
+    "time.sleep(0)",
+    'os.path.join("data", str(i))',
+    "result.append(transform(i))",
+]
+
+
+def generate_source(lines: int, loop_density: float = 0.15, call_density: float = 0.5, seed: int = 0) -> str:
+    """
+    生成一份大约 lines 行、语法正确的 Python 代码，由若干个 20 行左右的函数组成
+    - loop_density: 每条语句是 for / while 循环头的概率（循环最多嵌套 3 层）
+    - call_density: 普通语句是函数调用（而不是赋值）的概率
+    同样的参数和 seed 总是生成同样的代码
+    """
+    rng = random.Random(seed)
+    out = ["import os", "import time", ""]
+    index = 0
+    while len(out) < lines:
+        out.extend(_generate_function(rng, index, loop_density, call_density))
+        out.append("")
+        index += 1
+    return "\n".join(out) + "\n"
+
+
+def _generate_function(rng: random.Random, index: int, loop_density: float, call_density: float) -> list:
+    out = [f"def func_{index}(items, db, cursor, expr, result):"]
+    depth = 1
+    opened = False  # opened: 上一行是块头，这一行必须缩进进去
+    for _ in range(20):
+        if depth > 1 and not opened and rng.random() < 0.3:
+            depth -= 1
+        indent = "    " * depth
+        roll = rng.random()
+        if depth < 4 and roll < loop_density:
+            out.append(indent + rng.choice(["for i in items:", "while items:"]))
+            depth += 1
+            opened = True
+            continue
+        if depth < 4 and roll < loop_density + 0.05:
+            out.append(indent + "if i > 0:")
+            depth += 1
+            opened = True
+            continue
+        if rng.random() < call_density:
+            out.append(indent + rng.choice(_CALLS))
+        else:
+            out.append(indent + f"i = len(items) + {rng.randint(0, 99)}")
+        opened = False
+    if opened:
+        out.append("    " * depth + "i = 0")
+    out.append("    return result")
+    return out
+
+
+# HashEmbeddingFunction 在第一次用到时才定义，只跑 AST / tree-sitter 目标时不需要装 chromadb 和 numpy
+_hash_embedding_class = None
+
+
+def hash_embedding_function(dim: int = 32):
+    """
+    离线的嵌入函数：用 sha256 把文本确定性地映射成向量，不加载任何模型
+    只用来测规则检索本身的开销，向量没有语义
+    """
+    global _hash_embedding_class
+    if _hash_embedding_class is None:
+        import numpy as np
+        from chromadb.api.types import EmbeddingFunction
+
+        class HashEmbeddingFunction(EmbeddingFunction):
+            def __init__(self, dim: int = 32) -> None:
+                self.dim = dim
+
+            def __call__(self, input):
+                vectors = []
+                for text in input:
+                    digest = hashlib.sha256(text.encode("utf-8")).digest()
+                    vector = np.frombuffer(digest * (self.dim // len(digest) + 1), dtype=np.uint8)[:self.dim]
+                    vectors.append(vector.astype(np.float32) / 255.0)
+                return vectors
+
+            def name(self) -> str:
+                return "bench_hash"
+
+            def get_config(self) -> dict:
+                return {"dim": self.dim}
+
+            def is_legacy(self) -> bool:
+                # 不注册进 Chroma 的嵌入函数表
+                return True
+
+        _hash_embedding_class = HashEmbeddingFunction
+    return _hash_embedding_class(dim)
+
+
+class BenchEnv:
+    """
+    基准用到的共享资源，按需创建：临时规则库、内存规则索引、假的 LLM 审核器
+    chromadb / langchain 在第一次用到对应资源时才导入，没装时只有依赖它们的目标被跳过
+    """
+    def __init__(self) -> None:
+        self.tmpdir = None
+        self._collection = None
+        self._rule_index = None
+        self._reviewer = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            import chromadb
+            self.tmpdir = tempfile.mkdtemp(prefix="codereview-bench-")
+            collection = chromadb.PersistentClient(path=self.tmpdir).get_or_create_collection(
+                name="code_rules", embedding_function=hash_embedding_function())
+            collection.add(ids=[r[0] for r in BENCH_RULES], documents=[r[1] for r in BENCH_RULES],
+                           metadatas=[r[2] for r in BENCH_RULES])
+            self._collection = collection
+        return self._collection
+
+    @property
+    def rule_index(self) -> "ragde1.RuleIndex":
+        if self._rule_index is None:
+            import ragde1
+            self._rule_index = ragde1.RuleIndex.from_collection(self.collection)
+        return self._rule_index
+
+    @property
+    def reviewer(self) -> "aide1.Reviewer":
+        # 假模型按顺序循环返回固定回答，只测提示组装、上下文打包和链本身的开销
+        if self._reviewer is None:
+            import aide1
+            from langchain_core.language_models.fake_chat_models import FakeListChatModel
+            self._reviewer = aide1.Reviewer(FakeListChatModel(responses=["1. 问题：无\n2. 修复建议：无"]))
+        return self._reviewer
+
+    def close(self) -> None:
+        self._collection = None
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+
+# 基准目标：名称 -> setup(code, env)，setup 做完准备工作后返回要计时的无参函数
+TARGETS = {}
+
+
+def target(name: str):
+    def register(setup):
+        TARGETS[name] = setup
+        return setup
+    return register
+
+
+@target("ast.analyze")
+def _bench_analyze(code: str, env: BenchEnv):
+    return lambda: astde1.analyze_code(code, compact=True)
+
+
+@target("ast.extract_calls")
+def _bench_extract_calls(code: str, env: BenchEnv):
+    return lambda: astde1.extract_calls(code)
+
+
+@target("rule.engine")
+def _bench_rule_engine(code: str, env: BenchEnv):
+    engine = rulede1.RuleEngine(rulede1.default_rules() + rulede1.rules_from_index(env.rule_index))
+    return lambda: engine.run(code)
+
+
+@target("rag.check")
+def _bench_rag_check(code: str, env: BenchEnv):
+    import ragde1
+    calls = astde1.extract_calls(code)
+    collection, rule_index = env.collection, env.rule_index
+    return lambda: ragde1.rag_check(collection, calls, rule_index)
+
+
+@target("libcst.visitor")
+def _bench_libcst(code: str, env: BenchEnv):
+    import libcst as cst
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from ontest import fenxi
+
+    def run():
+        cst.metadata.MetadataWrapper(cst.parse_module(code)).visit(fenxi())
+    return run
+
+
+class _TreeSitterQualityChecker(walkde1.Visitor):
+    """
+    和 tree-sitter.stu.py 里的 CodeQualityChecker 一样：找出循环里的 connect / print 调用
+    """
+    def __init__(self) -> None:
+        self.issues = []
+        self.loop_depth = 0
+
+    def enter_for_statement(self, node) -> None:
+        self.loop_depth += 1
+
+    def leave_for_statement(self, node) -> None:
+        self.loop_depth -= 1
+
+    enter_while_statement = enter_for_statement
+    leave_while_statement = leave_for_statement
+
+    def enter_call(self, node) -> None:
+        if not self.loop_depth:
+            return
+        func = node.child_by_field_name("function")
+        if func is not None and func.text.decode("utf8").split(".")[-1] in ("connect", "print"):
+            self.issues.append(func.start_point[0] + 1)
+
+
+@target("tree_sitter.visitor")
+def _bench_tree_sitter(code: str, env: BenchEnv):
+    import grammarde1
+    parser = grammarde1.new_parser()
+    source = code.encode("utf8")
+
+    def run():
+        _TreeSitterQualityChecker().visit(parser.parse(source))
+    return run
+
+
+@target("tree_sitter.extract_calls")
+def _bench_tree_sitter_calls(code: str, env: BenchEnv):
+    import tsde1
+    return lambda: tsde1.extract_calls(code)
+
+
+@target("tree_sitter.incremental")
+def _bench_tree_sitter_incremental(code: str, env: BenchEnv):
+    """
+    编辑器场景：文件中间改一行后重新分析，两个版本来回切换
+    """
+    import tsde1
+    lines = code.split("\n")
+    middle = len(lines) // 2
+    edited = "\n".join(lines[:middle] + ["helper(0)"] + lines[middle:])
+    document = tsde1.TreeSitterDocument(code)
+    document.calls()
+    versions = [edited, code]
+
+    def run():
+        versions.reverse()
+        document.update(versions[0])
+        document.calls()
+    return run
+
+
+@target("tree_sitter.query")
+def _bench_tree_sitter_query(code: str, env: BenchEnv):
+    import tsrulede1
+    rules = tsrulede1.QueryRuleSet(rulede1.rules_from_index(env.rule_index))
+    return lambda: rules.check(code)
+
+
+@target("llm.review_file")
+def _bench_llm(code: str, env: BenchEnv):
+    import ragde1
+    violations = ragde1.rag_check(env.collection, astde1.extract_calls(code), env.rule_index)
+    reviewer = env.reviewer
+    return lambda: reviewer.review_file(code, violations)
+
+
+def percentile(samples: list, p: float) -> float:
+    """
+    最近秩法的百分位数
+    """
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def measure(func, repeat: int, warmup: int = 1) -> dict:
+    """
+    先预热 warmup 次，再计时 repeat 次；最后单独跑一次 tracemalloc 记内存峰值，
+    这样追踪内存的开销不会算进延迟里（C 扩展里的分配 tracemalloc 看不到）
+    """
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "repeat": repeat,
+        "p50_s": percentile(samples, 50),
+        "p99_s": percentile(samples, 99),
+        "mean_s": sum(samples) / len(samples),
+        "peak_bytes": peak,
+    }
+
+
+def run_benchmarks(sizes: list, targets: list, repeat: int = 5, loop_density: float = 0.15,
+                   call_density: float = 0.5, seed: int = 0) -> dict:
+    """
+    对每个规模生成一份语料，依次跑每个目标
+    返回 {"meta": 运行环境和参数, "results": [每个 (目标, 规模) 的结果]}
+    缺少可选依赖（libcst / tree-sitter）的目标跳过，记在 meta["skipped"] 里
+    """
+    env = BenchEnv()
+    results, skipped = [], {}
+    try:
+        for size in sizes:
+            code = generate_source(size, loop_density, call_density, seed)
+            lines = code.count("\n")
+            calls = len(astde1.extract_calls(code))
+            for name in targets:
+                if name in skipped:
+                    continue
+                try:
+                    func = TARGETS[name](code, env)
+                except ImportError as e:
+                    skipped[name] = str(e)
+                    print(f"⚠️  跳过 {name}: {e}")
+                    continue
+                result = {"target": name, "size": size, "lines": lines, "calls": calls, **measure(func, repeat)}
+                result["lines_per_s"] = lines / result["p50_s"] if result["p50_s"] else 0.0
+                result["calls_per_s"] = calls / result["p50_s"] if result["p50_s"] else 0.0
+                results.append(result)
+                print(format_row(result), flush=True)
+    finally:
+        env.close()
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {"sizes": sizes, "targets": targets, "repeat": repeat, "loop_density": loop_density,
+                   "call_density": call_density, "seed": seed},
+        "skipped": skipped,
+    }
+    return {"meta": meta, "results": results}
+
+
+HEADER = (f"{'target':<28}{'lines':>10}{'calls':>10}{'p50(ms)':>11}{'p99(ms)':>11}"
+          f"{'lines/s':>12}{'calls/s':>12}{'peak(MiB)':>11}")
+
+
+def format_row(result: dict) -> str:
+    return (f"{result['target']:<28}{result['lines']:>10}{result['calls']:>10}"
+            f"{result['p50_s'] * 1000:>11.2f}{result['p99_s'] * 1000:>11.2f}"
+            f"{result['lines_per_s']:>12.0f}{result['calls_per_s']:>12.0f}"
+            f"{result['peak_bytes'] / 1024 / 1024:>11.2f}")
+
+
+def compare(base: dict, current: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    按 (目标, 规模) 对比两次运行的 p50 延迟，返回变慢超过 threshold 的项：
+    [{"target", "size", "base_p50_s", "p50_s", "ratio"}]
+    只在一边出现的项不比较
+    """
+    baseline = {(r["target"], r["size"]): r for r in base["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = baseline.get((result["target"], result["size"]))
+        if old is None or not old["p50_s"]:
+            continue
+        ratio = result["p50_s"] / old["p50_s"]
+        if ratio > 1 + threshold:
+            regressions.append({"target": result["target"], "size": result["size"],
+                                "base_p50_s": old["p50_s"], "p50_s": result["p50_s"], "ratio": ratio})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线基准：AST → RAG → LLM 审查流水线")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="语料规模（行数）")
+    parser.add_argument("--targets", nargs="+", choices=list(TARGETS), default=list(TARGETS), help="要跑的目标")
+    parser.add_argument("--repeat", type=int, default=5, help="每个目标计时的次数")
+    parser.add_argument("--loop-density", type=float, default=0.15, help="语句是循环头的概率")
+    parser.add_argument("--call-density", type=float, default=0.5, help="普通语句是函数调用的概率")
+    parser.add_argument("--seed", type=int, default=0, help="生成语料的随机种子")
+    parser.add_argument("-o", "--output", help="把结果写成 JSON，供以后 --compare 使用")
+    parser.add_argument("--compare", metavar="BASE", help="和之前保存的 JSON 结果对比，有回退时退出码为 1")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="p50 变慢超过这个比例算回退，默认 0.1")
+    args = parser.parse_args()
+    print(HEADER)
+    report = run_benchmarks(args.sizes, args.targets, args.repeat, args.loop_density, args.call_density, args.seed)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📈 结果已写入 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for r in regressions:
+            print(f"❌ {r['target']} @ {r['size']} 行: p50 {r['base_p50_s'] * 1000:.2f}ms -> "
+                  f"{r['p50_s'] * 1000:.2f}ms ({r['ratio']:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ 没有超过 {args.threshold:.0%} 的性能回退")
@@ -0,0 +1,301 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+from chromadb.utils import embedding_functions
+
+import perfde1
+
+# 默认缓存文件，和 ./demodb.db 放在一起
+DEFAULT_EMBEDDING_CACHE = "./embcache.db"
+# Chroma 默认嵌入函数背后的模型
+DEFAULT_EMBEDDING_MODEL = "onnx/all-MiniLM-L6-v2"
+
+
+class EmbeddingCache:
+    """
+    按内容寻址的嵌入缓存：键是 sha256(模型id + 文本)，值是 float32 向量
+    存在 SQLite 里，超过 max_entries 时按最近使用时间做 LRU 淘汰
+    hits / misses 记录命中与未命中次数
+    """
+    def __init__(self, path: str = DEFAULT_EMBEDDING_CACHE, max_entries: int = 100_000) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model_id: str, text: str) -> str:
+        return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list) -> dict:
+        """
+        批量读取，返回 {键: 向量}，命中的条目顺便刷新最近使用时间
+        """
+        found = {}
+        with self._lock:
+            # SQLite 单条语句的参数个数有限制，分批查
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model_id: str, items: dict) -> None:
+        """
+        批量写入 {键: 向量}，写完后检查容量并淘汰最久没用过的条目
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(key, model_id, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                 for key, vector in items.items()]
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN"
+                    " (SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """
+    给任意 Chroma 嵌入函数套一层持久缓存
+    只有缓存里没有的文本才交给内层模型，并且去重后一次性嵌入
+    对 Chroma 来说它就是内层嵌入函数本身（名字和配置都沿用内层的）
+    """
+    def __init__(self, inner, cache: EmbeddingCache = None, model_id: str = None, name: str = None) -> None:
+        self.inner = inner
+        self.cache = cache if cache is not None else EmbeddingCache()
+        # model_id: 嵌入模型标识，换模型时缓存自然失效
+        self.model_id = model_id or f"{type(inner).__module__}.{type(inner).__qualname__}"
+        # name: 对 Chroma 报告的嵌入函数名，默认沿用内层的
+        self._name = name
+        # 模型第一次调用时才加载，加锁避免并发时重复加载
+        self._inner_lock = threading.Lock()
+
+    def __call__(self, input):
+        keys = [EmbeddingCache.key(self.model_id, text) for text in input]
+        found = self.cache.get_many(list(dict.fromkeys(keys)))
+        missing = {}  # missing: 键 -> 文本，缓存里没有、需要真正嵌入的
+        for key, text in zip(keys, input):
+            if key not in found:
+                missing.setdefault(key, text)
+        perfde1.incr("embedding.texts", len(keys))
+        perfde1.incr("embedding.computed", len(missing))
+        if missing:
+            with self._inner_lock, perfde1.stage("embedding.model"):
+                vectors = self.inner(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model_id, computed)
+            found.update(computed)
+        return [np.asarray(found[key], dtype=np.float32) for key in keys]
+
+    def name(self) -> str:
+        return self._name or self.inner.name()
+
+    def get_config(self) -> dict:
+        return {} if self._name else self.inner.get_config()
+
+    def is_legacy(self) -> bool:
+        # 不把包装类注册进 Chroma 的嵌入函数表，持久化配置保持内层函数原样
+        return True
+
+
+# 每个缓存文件在进程里只打开一次
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(path: str = DEFAULT_EMBEDDING_CACHE) -> EmbeddingCache:
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = EmbeddingCache(path)
+        return cache
+
+
+def _default_model():
+    # 新版 Chroma 的 DefaultEmbeddingFunction 每次调用都会新建一个 ONNXMiniLM_L6_V2（也就是重新加载模型），
+    # 这里直接持有一个实例，让 ONNX 会话在进程里常驻
+    onnx = getattr(embedding_functions, "ONNXMiniLM_L6_V2", None)
+    if onnx is None:
+        return embedding_functions.DefaultEmbeddingFunction()
+    return onnx()
+
+
+def cached_default_ef(path: str = DEFAULT_EMBEDDING_CACHE) -> CachedEmbeddingFunction:
+    """
+    带持久缓存的 Chroma 默认嵌入函数，对 Chroma 仍然报告为 "default"
+    """
+    return CachedEmbeddingFunction(_default_model(), get_embedding_cache(path),
+                                   DEFAULT_EMBEDDING_MODEL, name="default")
+
+
+# 默认的增量审查缓存文件
+DEFAULT_REVIEW_CACHE = "./reviewcache.db"
+
+
+class ReviewCache:
+    """
+    增量审查缓存，按文件内容哈希存两类结果：
+    - analysis: (内容哈希, 分析器版本) -> 调用点记录，规则变了也能复用，不必重新解析
+    - reviews:  (内容哈希, 规则集版本, 分析器版本) -> 违规列表，命中时整个文件直接跳过
+      （分析器版本并进 ruleset 列里存，旧缓存文件不用改表结构，升级分析器后旧结果自然不再命中）
+    """
+    def __init__(self, path: str = DEFAULT_REVIEW_CACHE) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis ("
+            " digest TEXT NOT NULL, analyzer TEXT NOT NULL, calls TEXT NOT NULL, PRIMARY KEY (digest, analyzer))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS reviews ("
+            " digest TEXT NOT NULL, ruleset TEXT NOT NULL, violations TEXT NOT NULL, PRIMARY KEY (digest, ruleset))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def digest(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def _get(self, sql: str, params: tuple):
+        with self._lock:
+            row = self._conn.execute(sql, params).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def _put(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+
+    def get_analysis(self, digest: str, analyzer: str):
+        return self._get("SELECT calls FROM analysis WHERE digest = ? AND analyzer = ?", (digest, analyzer))
+
+    def put_analysis(self, digest: str, analyzer: str, calls: list) -> None:
+        self._put("INSERT OR REPLACE INTO analysis (digest, analyzer, calls) VALUES (?, ?, ?)",
+                  (digest, analyzer, json.dumps(calls, ensure_ascii=False)))
+
+    @staticmethod
+    def _review_key(ruleset: str, analyzer: str) -> str:
+        return f"{ruleset}@{analyzer}"
+
+    def get_review(self, digest: str, ruleset: str, analyzer: str):
+        return self._get("SELECT violations FROM reviews WHERE digest = ? AND ruleset = ?",
+                         (digest, self._review_key(ruleset, analyzer)))
+
+    def put_review(self, digest: str, ruleset: str, analyzer: str, violations: list) -> None:
+        self._put("INSERT OR REPLACE INTO reviews (digest, ruleset, violations) VALUES (?, ?, ?)",
+                  (digest, self._review_key(ruleset, analyzer), json.dumps(violations, ensure_ascii=False)))
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# 默认的 LLM 回答缓存文件
+DEFAULT_LLM_CACHE = "./llmcache.db"
+
+
+class LLMResponseCache:
+    """
+    LLM 审核回答的持久缓存，键由调用方按 (规范化代码, 违规集合, 模板版本, 模型名) 算好传进来
+    """
+    def __init__(self, path: str = DEFAULT_LLM_CACHE) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, model: str, response: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created) VALUES (?, ?, ?, ?)",
+                (key, model, response, time.time())
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_llm_caches = {}
+
+
+def get_llm_cache(path: str = DEFAULT_LLM_CACHE) -> LLMResponseCache:
+    """
+    进程里共用的回答缓存，每个文件只打开一个 sqlite 连接
+    """
+    with _caches_lock:
+        cache = _llm_caches.get(path)
+        if cache is None:
+            cache = _llm_caches[path] = LLMResponseCache(path)
+        return cache
@@ -0,0 +1,273 @@
+import astde1
+
+_SCOPE_TYPES = ("FunctionDef", "AsyncFunctionDef")
+_IMPORT_TYPES = ("Import", "ImportFrom")
+_DEF_TYPES = ("FunctionDef", "AsyncFunctionDef", "ClassDef")
+
+# 发给模型的代码 + RAG 报告的默认 token 预算
+# 模型上下文（aide1.REVIEW_NUM_CTX）里还要留出提示模板和回答的位置
+DEFAULT_TOKEN_BUDGET = 4096
+# 一次批量审核最多放几个文件，文件越多回答越长，也越容易漏掉文件
+BATCH_MAX_FILES = 8
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计 token 数：ASCII 大约 4 个字符一个 token，中文等非 ASCII 字符按一个字一个 token 算
+    只用来做预算，不需要精确
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def violation_tokens(violations: list) -> int:
+    """
+    违规列表写进 RAG 报告后大约占多少 token（每条另加报告模板的固定开销）
+    """
+    return sum(estimate_tokens(v["code"]) + estimate_tokens(v["rule"]) + 24 for v in violations)
+
+
+def file_tokens(code: str, violations: list) -> int:
+    """
+    一个文件连同它的报告在批量提示里大约占多少 token（另加文件标题的开销）
+    """
+    return estimate_tokens(code) + violation_tokens(violations) + 16
+
+
+def pack_batches(costs: list, budget: int = DEFAULT_TOKEN_BUDGET, max_files: int = BATCH_MAX_FILES) -> list:
+    """
+    按顺序把文件贪心地分成若干批，每批的 token 总数不超过预算、文件数不超过 max_files
+    超过半个预算的文件不算小文件，单独成一批
+    costs: 每个文件的 token 数（file_tokens）
+    返回 [[文件下标]]
+    """
+    batches = []
+    current, used = [], 0
+    for i, cost in enumerate(costs):
+        if cost > budget // 2:
+            batches.append([i])
+            continue
+        if current and (used + cost > budget or len(current) >= max_files):
+            batches.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def affected_scopes(table: astde1.NodeTable, lines: list) -> list:
+    """
+    把行号映射到 analyze_code 已经记录的节点位置上：
+    行在函数里时取最内层的函数，否则取包含它的顶层语句（比如模块级的循环）
+    返回按行号排序、去重后的 [(起始行, 结束行, 名称)]
+    """
+    candidates = []  # candidates: (起始行, 结束行, 名称, 是否函数)
+    for i in range(len(table)):
+        if table.lineno[i] < 0:
+            continue
+        type_name = table.type_name(i)
+        if type_name in _SCOPE_TYPES:
+            node = table.nodes[i]
+            start = min([table.lineno[i]] + [d.lineno for d in node.decorator_list])
+            candidates.append((start, table.end_lineno[i], node.name, True))
+        elif table.parent[i] == 0:
+            candidates.append((table.lineno[i], table.end_lineno[i], type_name, False))
+    scopes = set()
+    for line in lines:
+        best = None
+        for start, end, name, is_function in candidates:
+            if not start <= line <= end:
+                continue
+            # 优先函数，其次越靠内（起始行越大）越好
+            if best is None or (is_function, start) > (best[3], best[0]):
+                best = (start, end, name, is_function)
+        if best is not None:
+            scopes.add(best[:3])
+    # 去掉被其他作用域完全包含的作用域
+    result = []
+    for scope in sorted(scopes, key=lambda s: (s[0], -s[1])):
+        if result and scope[1] <= result[-1][1]:
+            continue
+        result.append(scope)
+    return result
+
+
+def scoped_source(code: str, scopes: list) -> str:
+    """
+    只拼出给定作用域的源码，每段前面标上行号范围，发给 AI 用
+    """
+    return _scoped_lines(code.splitlines(), scopes)
+
+
+def _scoped_lines(lines: list, scopes: list) -> str:
+    parts = []
+    for start, end, name in scopes:
+        parts.append(f"# --- 第 {start}-{end} 行: {name} ---")
+        parts.extend(lines[start - 1:end])
+    return "\n".join(parts)
+
+
+def locate_violations(code: str, violations: list) -> list:
+    """
+    找出每条违规对应的调用点行号，返回 [(行号, 违规)]
+    违规记录里只有代码片段和场景，这里按 (片段, 场景) 和 extract_calls 的调用点对上；
+    违规列表和调用点都是按源码顺序排的，同样的片段出现多次时按顺序一一对应
+    """
+    wanted = {}  # wanted: (代码片段, 场景) -> 还没对上调用点的违规列表
+    for v in reversed(violations):
+        wanted.setdefault((v["code"], v.get("context", "anywhere")), []).append(v)
+    located = []
+    for site in astde1.extract_calls(code):
+        contexts = []
+        if site.in_loop:
+            contexts.append("loop")
+        if site.in_if:
+            contexts.append("if")
+        if not contexts:
+            contexts.append("anywhere")
+        for context in contexts:
+            pending = wanted.get((site.code, context))
+            if pending:
+                located.append((site.lineno, pending.pop()))
+    return located
+
+
+def _import_block(table: astde1.NodeTable) -> str:
+    return "\n".join(table.segment(i) for i in range(len(table))
+                     if table.parent[i] == 0 and table.type_name(i) in _IMPORT_TYPES)
+
+
+def _top_level_scopes(table: astde1.NodeTable) -> list:
+    """
+    没有违规可定位时按顶层语句切分整个文件（import 已经放在公共头里，跳过）
+    """
+    scopes = []
+    for i in range(len(table)):
+        if table.parent[i] != 0 or table.lineno[i] < 0:
+            continue
+        type_name = table.type_name(i)
+        if type_name in _IMPORT_TYPES:
+            continue
+        node = table.nodes[i]
+        start = min([table.lineno[i]] + [d.lineno for d in getattr(node, "decorator_list", ())])
+        scopes.append((start, table.end_lineno[i], getattr(node, "name", type_name)))
+    return scopes
+
+
+def _outline(table: astde1.NodeTable, lines: list, selected: list) -> list:
+    """
+    没被选中的函数和类只保留签名行，让模型知道文件里还有哪些定义
+    返回 [(行号, 签名文本)]
+    """
+    outline = []
+    for i in range(len(table)):
+        if table.type_name(i) not in _DEF_TYPES:
+            continue
+        start = table.lineno[i]
+        if any(s <= start <= e for s, e, _ in selected):
+            continue
+        node = table.nodes[i]
+        # 多行签名取到函数体的前一行为止
+        end = max(start, node.body[0].lineno - 1)
+        outline.append((start, "\n".join(lines[start - 1:end])))
+    return outline
+
+
+def _split_scope(start: int, end: int, name: str, lines: list, budget: int) -> list:
+    """
+    单个作用域超过预算时按行切成若干段，每段都不超过预算
+    """
+    pieces = []
+    piece_start = start
+    used = 0
+    for lineno in range(start, end + 1):
+        cost = estimate_tokens(lines[lineno - 1]) + 1
+        if used and used + cost > budget:
+            pieces.append((piece_start, lineno - 1, name))
+            piece_start, used = lineno, 0
+        used += cost
+    pieces.append((piece_start, end, name))
+    return pieces
+
+
+def _pack_lines(lines: list, violations: list, budget: int) -> list:
+    """
+    没有语法树可用时，把整个文件按行切成不超过预算的若干块，违规都放进第一块的报告
+    """
+    room = max(budget - violation_tokens(violations), budget // 2)
+    return [{"code": _scoped_lines(lines, [piece]), "violations": list(violations) if n == 0 else []}
+            for n, piece in enumerate(_split_scope(1, len(lines), "<module>", lines, room))]
+
+
+def pack_context(code: str, violations: list, budget: int = DEFAULT_TOKEN_BUDGET) -> list:
+    """
+    按 token 预算挑选发给模型的上下文
+    - 整个文件加报告放得下时原样返回，小文件的提示和以前完全一样
+    - 放不下时只保留 import、含违规的函数（没有违规时按顶层语句切分整个文件），
+      再在剩余预算里补上其他定义的签名
+    - 一块还放不下时切成多块，交给调用方逐块审核再汇总（map-reduce）
+    - 代码无法解析（比如 tree-sitter 容错解析出来的半截文件）时按行切分整个文件
+    返回 [{"code": 代码, "violations": 这一块涉及的违规}]
+    """
+    if estimate_tokens(code) + violation_tokens(violations) <= budget:
+        return [{"code": code, "violations": list(violations)}]
+    lines = code.splitlines()
+    try:
+        table = astde1.analyze_code(code, compact=True)
+        located = locate_violations(code, violations)
+    except (SyntaxError, ValueError):
+        return _pack_lines(lines, violations, budget)
+    header = _import_block(table)
+    if estimate_tokens(header) > budget // 4:
+        # import 多得离谱时不再每块都带上
+        header = ""
+    if located:
+        scopes = affected_scopes(table, sorted({lineno for lineno, _ in located}))
+    else:
+        scopes = _top_level_scopes(table)
+    room = budget - estimate_tokens(header)
+    pieces = []  # pieces: (起始行, 结束行, 名称, 违规列表, token 数)
+    for start, end, name in scopes:
+        scope_violations = []
+        for lineno, v in located:
+            if start <= lineno <= end and all(v is not seen for seen in scope_violations):
+                scope_violations.append(v)
+        piece_room = max(room - violation_tokens(scope_violations), room // 2)
+        for s, e, n in _split_scope(start, end, name, lines, piece_room):
+            piece_violations = [v for v in scope_violations
+                                if any(s <= lineno <= e and v is found for lineno, found in located)]
+            cost = estimate_tokens(_scoped_lines(lines, [(s, e, n)])) + violation_tokens(piece_violations)
+            pieces.append((s, e, n, piece_violations, cost))
+    chunks = []  # chunks: [(作用域列表, 违规列表, token 数)]
+    for s, e, n, piece_violations, cost in pieces:
+        if not chunks or chunks[-1][2] + cost > room:
+            chunks.append(([], [], 0))
+        chunk_scopes, chunk_violations, used = chunks[-1]
+        chunk_scopes.append((s, e, n))
+        chunk_violations.extend(v for v in piece_violations if all(v is not seen for seen in chunk_violations))
+        chunks[-1] = (chunk_scopes, chunk_violations, used + cost)
+    if not chunks:
+        chunks.append(([], [], 0))
+    # 定位不到调用点的违规（比如分析结果和代码对不上）放进第一块的报告，不丢掉
+    found_ids = {id(v) for _, v in located}
+    chunks[0][1].extend(v for v in violations if id(v) not in found_ids)
+    outline = []
+    if len(chunks) == 1:
+        # 签名只是参考，最多占预算的四分之一
+        left = min(room - chunks[0][2], budget // 4)
+        for lineno, signature in _outline(table, lines, chunks[0][0]):
+            cost = estimate_tokens(signature) + 1
+            if cost > left:
+                break
+            outline.append(signature)
+            left -= cost
+    packed = []
+    for chunk_scopes, chunk_violations, _ in chunks:
+        parts = [header] if header else []
+        if outline:
+            parts.append("# --- 其他定义（只保留签名） ---\n" + "\n".join(outline))
+        parts.append(_scoped_lines(lines, chunk_scopes))
+        packed.append({"code": "\n\n".join(parts), "violations": chunk_violations})
+    return packed
@@ -0,0 +1,203 @@
+import argparse
+import difflib
+import os
+import re
+import subprocess
+
+import aide1
+import astde1
+import ctxde1
+import logde1
+import ragde1
+
+_HUNK_HEADER = re.compile(r"^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def parse_unified_diff(diff_text: str) -> dict:
+    """
+    解析 unified diff，返回 {新文件路径: [改动的行号(新文件里的)]}
+    新增 / 修改的行直接记录；纯删除记在删除位置的下一行上
+    被删除的文件不出现在结果里
+    按 @@ 头里的行数记住这一块还剩几行，块内以 "--- " / "+++ " 开头的删除 / 新增行不会被当成文件头
+    """
+    changes = {}
+    path = None
+    new_line = 0
+    old_left = new_left = 0  # old_left / new_left: 当前块里还没读到的旧文件行数 / 新文件行数
+    for line in diff_text.splitlines():
+        if old_left > 0 or new_left > 0:
+            # 块内的行：按第一个字符区分新增 / 删除 / 上下文（空行是去掉了行尾空格的上下文行）
+            tag = line[:1]
+            if tag == "+":
+                new_left -= 1
+                if path is not None:
+                    changes[path].append(new_line)
+                new_line += 1
+            elif tag == "-":
+                old_left -= 1
+                if path is not None:
+                    changes[path].append(max(new_line, 1))
+            elif tag in (" ", ""):
+                old_left -= 1
+                new_left -= 1
+                new_line += 1
+            # 其余的（"\ No newline at end of file"）不占行数
+            continue
+        if line.startswith("+++ "):
+            target = line[4:].split("\t")[0].strip()
+            path = None if target == "/dev/null" else (target[2:] if target.startswith("b/") else target)
+            if path is not None:
+                changes.setdefault(path, [])
+            continue
+        if line.startswith("--- "):
+            continue
+        match = _HUNK_HEADER.match(line)
+        if match:
+            old_left = int(match.group(1) or 1)
+            new_line = int(match.group(2))
+            new_left = int(match.group(3) or 1)
+            if path is not None and new_left == 0:
+                # 这一块只有删除，起始行号指向删除位置的前一行
+                changes[path].append(max(new_line, 1))
+    return {path: sorted(set(lines)) for path, lines in changes.items()}
+
+
+def changed_lines(old_code: str, new_code: str) -> list:
+    """
+    比较两个版本的代码，返回新版本里改动的行号
+    """
+    old_lines = old_code.splitlines()
+    new_lines = new_code.splitlines()
+    lines = set()
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if j2 > j1:
+            lines.update(range(j1 + 1, j2 + 1))
+        else:
+            lines.add(max(min(j1 + 1, len(new_lines)), 1))
+    return sorted(lines)
+
+
+def review_changes(code: str, lines: list, store: ragde1.RuleStore = None, llm: bool = False, model=None) -> dict:
+    """
+    只对改动涉及的作用域做规则匹配和 AI 审核
+    调用点的 loop/if 环境仍然按整个文件计算，所以作用域外层的循环也会被算上
+    """
+    if store is None:
+        store = ragde1.get_rule_store()
+    # 只解析一次，节点表和调用点共用同一棵语法树
+    tree = astde1.parse_code(code)
+    scopes = ctxde1.affected_scopes(astde1.analyze_code(code, compact=True, tree=tree), lines)
+    calls = astde1.extract_calls(code, tree=tree)
+    scoped_calls = astde1.CallIndex()
+    for site in calls:
+        if any(start <= site.lineno <= end for start, end, _ in scopes):
+            scoped_calls.add(site)
+    violations = store.check(scoped_calls)
+    report = aide1.format_report(violations)
+    snippet = ctxde1.scoped_source(code, scopes)
+    review = None
+    if llm and scopes:
+        review = aide1.ai_code_review(snippet, report, model)
+    return {
+        "scopes": scopes,
+        "violations": violations,
+        "report": report,
+        "code": snippet,
+        "review": review,
+        "error": None,
+    }
+
+
+def _review_file(read, lines: list, **kwargs) -> dict:
+    """
+    读取并审查一个文件；读不出来或解析失败时只在这个文件的结果里记下错误，不影响其他文件
+    read: 返回文件内容的函数
+    """
+    try:
+        return review_changes(read(), lines, **kwargs)
+    except (OSError, UnicodeDecodeError, SyntaxError, ValueError) as e:
+        return {"scopes": [], "violations": [], "report": "", "code": "", "review": None,
+                "error": f"{type(e).__name__}: {e}"}
+
+
+def review_code_diff(old_code: str, new_code: str, **kwargs) -> dict:
+    """
+    两个版本的代码：只审查新版本里改动涉及的函数和循环
+    """
+    return review_changes(new_code, changed_lines(old_code, new_code), **kwargs)
+
+
+def review_unified_diff(diff_text: str, root: str = ".", **kwargs) -> dict:
+    """
+    unified diff（比如 git diff 的输出）：按 diff 里的新路径从工作区读取改动后的文件
+    返回 {路径: 审查结果}
+    """
+    results = {}
+    for path, lines in parse_unified_diff(diff_text).items():
+        if not path.endswith(".py") or not lines:
+            continue
+        results[path] = _review_file(lambda: _read(os.path.join(root, path)), lines, **kwargs)
+    return results
+
+
+def _read(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def review_revisions(base: str, head: str = None, root: str = ".", **kwargs) -> dict:
+    """
+    两个 git 版本之间的改动；head 为 None 时和工作区比较
+    """
+    revisions = [base] if head is None else [base, head]
+    # 固定 a/ b/ 前缀，不受 diff.noprefix / diff.mnemonicPrefix 等配置影响
+    diff_text = subprocess.run(["git", "diff", "--no-color", "--src-prefix=a/", "--dst-prefix=b/",
+                                *revisions, "--", "*.py"],
+                               cwd=root, check=True, capture_output=True, text=True).stdout
+    if head is None:
+        return review_unified_diff(diff_text, root, **kwargs)
+    results = {}
+    for path, lines in parse_unified_diff(diff_text).items():
+        if not lines:
+            continue
+        results[path] = _review_file(lambda: _git_show(root, head, path), lines, **kwargs)
+    return results
+
+
+def _git_show(root: str, revision: str, path: str) -> str:
+    content = subprocess.run(["git", "show", f"{revision}:{path}"], cwd=root, check=True,
+                             capture_output=True).stdout
+    return content.decode("utf-8")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="只审查改动涉及的函数和循环")
+    parser.add_argument("base", nargs="?", default="HEAD", help="基准版本，默认 HEAD")
+    parser.add_argument("head", nargs="?", default=None, help="目标版本，默认工作区")
+    parser.add_argument("--diff", help="直接读取 unified diff 文件，而不是调用 git diff")
+    parser.add_argument("--root", default=".", help="仓库根目录")
+    parser.add_argument("--llm", action="store_true", help="对改动的作用域调用 AI 审核")
+    logde1.add_arguments(parser)
+    args = parser.parse_args()
+    logde1.configure_from_args(args)
+
+    if args.diff:
+        with open(args.diff, encoding="utf-8") as f:
+            results = review_unified_diff(f.read(), args.root, llm=args.llm)
+    else:
+        results = review_revisions(args.base, args.head, args.root, llm=args.llm)
+    for path, result in results.items():
+        print("=" * 60)
+        scopes = ", ".join(f"{name}({start}-{end})" for start, end, name in result["scopes"])
+        print(f"📄 {path}  受影响的作用域: {scopes or '无'}")
+        if result["error"]:
+            print(f"❌ {result['error']}")
+            continue
+        print(result["report"])
+        if result["review"]:
+            print("🤖 AI审核意见:")
+            print(result["review"])
+    print("over")
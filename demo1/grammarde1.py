@@ -0,0 +1,94 @@
+import ctypes
+import os
+import threading
+
+from tree_sitter import Language, Parser
+
+# 环境变量：预编译语法库（.so / .dll）的路径，设置了就优先用它（即使装了 tree-sitter-python 包）
+GRAMMAR_ENV = "CODEREVIEW_TS_GRAMMAR"
+
+# 没设置环境变量时依次查找的预编译语法库（相对仓库根目录和当前目录）
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIBRARY_PATHS = (os.path.join(_REPO_ROOT, "build", "my-languages.so"), os.path.join("build", "my-languages.so"))
+
+_language = None
+_language_lock = threading.Lock()
+# 每个线程一个 Parser（Parser 不是线程安全的）；进程池的每个子进程有自己的模块状态，各自懒加载
+_local = threading.local()
+
+
+def _load_packaged():
+    """
+    pip 安装的 tree-sitter-python 自带编译好的语法，直接加载，不需要编译器和网络
+    """
+    import tree_sitter_python
+    return Language(tree_sitter_python.language())
+
+
+def _load_library(path: str):
+    """
+    从预编译的语法库加载：0.22 以前的 Language(路径, 语言名)，之后的版本通过 ctypes 取语法指针
+    """
+    try:
+        return Language(path, "python")
+    except TypeError:
+        entry = ctypes.CDLL(os.path.abspath(path)).tree_sitter_python
+        entry.restype = ctypes.c_void_p
+        return Language(entry())
+
+
+def _load() -> Language:
+    env_path = os.environ.get(GRAMMAR_ENV)
+    if env_path:
+        if not os.path.exists(env_path):
+            raise ImportError(f"环境变量 {GRAMMAR_ENV} 指定的语法库不存在：{env_path}")
+        return _load_library(env_path)
+    try:
+        return _load_packaged()
+    except ImportError:
+        pass
+    for path in LIBRARY_PATHS:
+        if os.path.exists(path):
+            return _load_library(path)
+    raise ImportError(f"找不到 tree-sitter 的 Python 语法：请 pip install tree-sitter-python，"
+                      f"或用环境变量 {GRAMMAR_ENV} 指定预编译的语法库")
+
+
+def language() -> Language:
+    """
+    Python 语法，进程内只加载一次
+    加载顺序：环境变量 CODEREVIEW_TS_GRAMMAR 指定的库 -> tree-sitter-python 包 -> build/my-languages.so
+    都没有时抛出 ImportError；不会在运行时编译语法或访问网络
+    """
+    global _language
+    if _language is None:
+        with _language_lock:
+            if _language is None:
+                _language = _load()
+    return _language
+
+
+def new_parser() -> Parser:
+    """
+    新建一个 Python 解析器，兼容 Parser(语言)、parser.language = 语言 和旧版的 set_language
+    """
+    lang = language()
+    try:
+        return Parser(lang)
+    except TypeError:
+        parser = Parser()
+    if hasattr(parser, "set_language"):
+        parser.set_language(lang)
+    else:
+        parser.language = lang
+    return parser
+
+
+def parser() -> Parser:
+    """
+    当前线程的解析器，第一次调用时创建，之后同一线程解析所有文件都复用它
+    """
+    current = getattr(_local, "parser", None)
+    if current is None:
+        current = _local.parser = new_parser()
+    return current
@@ -0,0 +1,100 @@
+import json
+import logging
+import logging.handlers
+import os
+import sys
+
+# 所有模块的日志都挂在这个名字下面
+LOGGER_NAME = "codereview"
+
+# 日志级别：quiet 只输出警告和错误，summary 每个文件一行汇总，trace 额外输出每个调用点的匹配过程
+LEVELS = {"quiet": logging.WARNING, "summary": logging.INFO, "trace": logging.DEBUG}
+
+# 环境变量，没有在命令行指定级别时使用
+LEVEL_ENV = "CODEREVIEW_LOG"
+
+# 没有配置或配置了不认识的级别时使用
+DEFAULT_LEVEL = "summary"
+
+# 也接受 logging 的标准级别名（不区分大小写）
+_LEVEL_ALIASES = {"debug": "trace", "info": "summary", "warn": "quiet", "warning": "quiet", "error": "quiet",
+                  "critical": "quiet"}
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def log(logger: logging.Logger, level: int, event: str, lines: list = None, **fields) -> None:
+    """
+    输出一条结构化日志：event 是事件名，fields 是键值对，lines 是附带的多行明细（比如一个文件的全部 trace）
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields, "lines": lines or []})
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    text: 时间 级别 模块 事件 key=value ...，明细逐行缩进跟在后面
+    json: 每条日志一行 JSON，明细放在 lines 字段里
+    """
+    def __init__(self, fmt: str = "text") -> None:
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", {})
+        lines = getattr(record, "lines", [])
+        if self.fmt == "json":
+            payload = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                       "event": record.getMessage(), **fields}
+            if lines:
+                payload["lines"] = lines
+            return json.dumps(payload, ensure_ascii=False, default=str)
+        head = " ".join([self.formatTime(record), record.levelname, record.name, record.getMessage()]
+                        + [f"{key}={value}" for key, value in fields.items()])
+        return "\n".join([head] + [f"    {line}" for line in lines])
+
+
+def configure(level: str = None, fmt: str = "text", stream=None, buffer: int = 200) -> logging.Logger:
+    """
+    给命令行入口用的日志配置，库代码本身不配置任何 handler
+    - level: quiet / summary / trace（或 debug / info / warning 等标准级别名，不区分大小写），
+      不传时读环境变量 CODEREVIEW_LOG，默认 summary；不认识的值按 summary 处理并输出一条警告
+    - buffer: 先在内存里攒这么多条再一起写出（遇到警告立即写出），0 表示不缓冲；
+      常驻服务建议用 0，否则日志会一直攒在内存里
+    重复调用时替换上一次的配置
+    """
+    requested = level or os.environ.get(LEVEL_ENV) or DEFAULT_LEVEL
+    level = str(requested).strip().lower()
+    level = _LEVEL_ALIASES.get(level, level)
+    unknown = level not in LEVELS
+    if unknown:
+        level = DEFAULT_LEVEL
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(StructuredFormatter(fmt))
+    if buffer > 0:
+        handler = logging.handlers.MemoryHandler(buffer, flushLevel=logging.WARNING, target=handler)
+    logger.addHandler(handler)
+    logger.setLevel(LEVELS[level])
+    logger.propagate = False
+    if unknown:
+        log(logger, logging.WARNING, "unknown_log_level", value=requested, fallback=level)
+    return logger
+
+
+def add_arguments(parser) -> None:
+    """
+    给 argparse 加上 --log-level / --log-format
+    """
+    parser.add_argument("--log-level", choices=list(LEVELS), default=None,
+                        help=f"日志级别，默认读环境变量 {LEVEL_ENV}，都没有时为 summary")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text", help="日志格式")
+
+
+def configure_from_args(args, buffer: int = 200) -> logging.Logger:
+    return configure(args.log_level, args.log_format, buffer=buffer)
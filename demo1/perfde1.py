@@ -0,0 +1,181 @@
+import contextlib
+import cProfile
+import functools
+import inspect
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+class Metrics:
+    """
+    进程内的指标登记表，线程安全
+    - stages:   阶段名 -> [调用次数, 总耗时(秒), 单次最长耗时(秒)]
+    - counters: 计数器，比如嵌入条数、Chroma 查询次数、LLM token 数
+    - gauges:   瞬时值，比如 tracemalloc 记录的内存峰值
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        记录一个阶段的墙钟时间和调用次数（出异常也照样记录）
+        with METRICS.stage("ast.parse"):
+            ...
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str):
+        """
+        装饰器版本的 stage，同步函数和 async 函数都可以用
+        """
+        def decorate(func):
+            if inspect.iscoroutinefunction(func):
+                async def wrapper(*args, **kwargs):
+                    with self.stage(name):
+                        return await func(*args, **kwargs)
+            else:
+                def wrapper(*args, **kwargs):
+                    with self.stage(name):
+                        return func(*args, **kwargs)
+            return functools.wraps(func)(wrapper)
+        return decorate
+
+    def observe(self, name: str, seconds: float, count: int = 1) -> None:
+        with self._lock:
+            entry = self.stages.get(name)
+            if entry is None:
+                self.stages[name] = [count, seconds, seconds]
+            else:
+                entry[0] += count
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def incr(self, name: str, value=1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "stages": {name: {"count": count, "total_s": total, "max_s": longest,
+                                  "mean_s": total / count if count else 0.0}
+                           for name, (count, total, longest) in sorted(self.stages.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": dict(sorted(self.gauges.items())),
+            }
+
+    def drain(self) -> dict:
+        """
+        取出当前的指标并清零，子进程把自己的指标交回主进程时用
+        """
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        把另一个进程 snapshot / drain 出来的指标合并进来
+        """
+        with self._lock:
+            for name, stage in snapshot.get("stages", {}).items():
+                entry = self.stages.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += stage["count"]
+                entry[1] += stage["total_s"]
+                entry[2] = max(entry[2], stage["max_s"])
+            for name, value in snapshot.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.gauges.update(snapshot.get("gauges", {}))
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def to_json(self, indent: int = 2) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=indent)
+
+    def to_prometheus(self, prefix: str = "codereview") -> str:
+        """
+        导出 Prometheus 文本格式
+        """
+        snapshot = self.snapshot()
+        lines = []
+        stages = snapshot["stages"]
+        for metric, field, kind in (("stage_calls_total", "count", "counter"),
+                                    ("stage_seconds_total", "total_s", "counter"),
+                                    ("stage_max_seconds", "max_s", "gauge")):
+            if not stages:
+                break
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for name, stage in stages.items():
+                lines.append(f'{prefix}_{metric}{{stage="{name}"}} {stage[field]}')
+        for name, value in snapshot["counters"].items():
+            metric = f"{prefix}_{_metric_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, value in snapshot["gauges"].items():
+            metric = f"{prefix}_{_metric_name(name)}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _metric_name(name: str) -> str:
+    return "".join(ch if ch.isalnum() else "_" for ch in name)
+
+
+# 进程里共享的指标登记表，各模块直接用 perfde1.stage / perfde1.incr 记录
+METRICS = Metrics()
+stage = METRICS.stage
+timed = METRICS.timed
+incr = METRICS.incr
+
+
+@contextlib.contextmanager
+def profile(path: str = None, memory: bool = False, top: int = 25):
+    """
+    深入排查用的性能剖析：
+    - cProfile 统计函数耗时，给了 path 时把原始数据写进文件（可用 snakeviz 等工具查看），
+      否则打印按累计耗时排序的前 top 个函数
+    - memory=True 时同时开启 tracemalloc，打印分配最多的代码行，并把内存峰值记到 METRICS
+    """
+    profiler = cProfile.Profile()
+    if memory:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            METRICS.set_gauge("memory.peak_bytes", peak)
+            print(f"📈 内存峰值: {peak / 1024 / 1024:.2f} MiB，分配最多的代码行:")
+            for stat in snapshot.statistics("lineno")[:top]:
+                print(f"  {stat}")
+        if path:
+            profiler.dump_stats(path)
+            print(f"📈 cProfile 数据已写入 {path}")
+        else:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top)
+            print(out.getvalue())
@@ -1,12 +1,23 @@
 from gc import collect
+import hashlib
+import json
+import threading
 import chromadb
 from chromadb.utils import embedding_functions
+import logging
+
 import astde1
-def init_rag_db():
+import cachede1
+import logde1
+import perfde1
+logger = logde1.get_logger("rag")
+
+def init_rag_db(path="./demodb.db", default_ef=None):
     # client: ChromaDB持久化客户端（英文：client - 客户端，这里指连接到ChromaDB的客户端对象）
-    client = chromadb.PersistentClient(path="./demodb.db")
-    # default_ef: 默认嵌入函数（英文：default embedding function，用于生成文本的向量表示）
-    default_ef=embedding_functions.DefaultEmbeddingFunction()
+    client = chromadb.PersistentClient(path=path)
+    # default_ef: 默认嵌入函数（英文：default embedding function，用于生成文本的向量表示），套了一层持久嵌入缓存
+    if default_ef is None:
+        default_ef=cachede1.cached_default_ef()
     # collection: 代码规则集合（英文：collection - 集合，这里指存储代码规则的数据库集合）
     collection=client.get_or_create_collection(
         name="code_rules",
@@ -59,7 +70,7 @@ def init_rag_db():
         }
     )                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                        
     
-    print(f"✅ RAG 数据库初始化完成，已加载 {collection.count()} 条规则。")
+    logde1.log(logger, logging.INFO, "rules_loaded", path=path, rules=collection.count())
     return collection                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                              
 def extract_action_name(code_snippet: str) -> str:
     """
@@ -79,101 +90,345 @@ def insert(inserted:list):
     # inserted: 要插入的数据列表（英文：inserted - 已插入的，这里指待插入的数据）
     # matebase: 元数据库（英文：meta base 的拼写错误，应该是 metadata base，指存储元数据的数据库）
     matebase=[]
-    print("insert yes")
-def rag_check(collection,results:list):
-    # collection: ChromaDB集合对象（英文：collection - 集合，这里指存储规则的数据库集合）
-    # results: AST分析结果列表（英文：results - 结果，这里指AST解析后得到的代码结构信息）
-    print("query_open")
-    violations=[]  # violations: 违规列表（英文：violations - 违规，存储检测到的所有违规情况）
-    for i in results:  # i: 遍历的每个AST节点信息（英文：i - 循环变量，代表results列表中的每个元素）
+    logde1.log(logger, logging.INFO, "insert", rows=len(inserted))
+def iter_call_records(results):
+    """
+    把分析结果统一成 (代码片段, 动作名, 是否在循环中, 是否在if中)
+    results 可以是 astde1.extract_calls 的 CallIndex，也可以是 analyze_code 的 list of dict
+    （CallSite.to_dict 的记录自带 action，直接用）
+    """
+    if isinstance(results, astde1.CallIndex):
+        for site in results:
+            yield site.code, site.action, site.in_loop, site.in_if
+        return
+    for i in results:
         if i['type']!='Call':
             continue
-        code_snippet=i["code"]  # code_snippet: 代码片段（英文：code snippet - 代码片段，指当前检测到的函数调用代码）
-        action_name=extract_action_name(code_snippet)  # action_name: 动作名称（英文：action name - 动作名称，指函数调用的名称，如print、connect等）
-        is_in_loop=i['in_loop']  # is_in_loop: 是否在循环中（英文：is in loop - 是否在循环中，布尔值，True表示当前代码在循环内）
-        is_in_if=i["in_if"]  # is_in_if: 是否在if语句中（英文：is in if - 是否在if语句中，布尔值，True表示当前代码在if分支内）
-        print(f"--> 检测到动作: {action_name} (代码: {code_snippet})")
-        print(f"    环境状态: 在循环中={is_in_loop}, 在if中={is_in_if}")
+        yield i["code"], i.get("action") or extract_action_name(i["code"]), i['in_loop'], i["in_if"]
+
+
+# 语义规则的最大向量距离，超过这个距离不算命中
+SEMANTIC_MAX_DISTANCE = 0.35
+
+
+class RuleIndex:
+    """
+    内存规则索引：启动时从 code_rules 集合的元数据一次性加载
+    精确规则按 (action, forbidden_in) 放进字典，O(1) 命中，不需要嵌入也不需要 ANN 查询；
+    元数据里 match == "semantic" 的模糊规则才保留给向量检索
+    """
+    def __init__(self, ids: list, documents: list, metadatas: list) -> None:
+        self.exact = {}          # exact: (动作名, 场景) -> 规则
+        self.semantic = {}       # semantic: 场景 -> 该场景下语义规则的数量
+        rows = sorted(zip(ids, documents, [meta or {} for meta in metadatas]), key=lambda r: r[0])
+        # source_count: 加载的规则记录条数（精确规则里重复的 (动作, 场景) 也算），和集合的 count() 对得上
+        self.source_count = len(rows)
+        # version: 规则集版本，规则内容有任何变化都会改变，用作增量审查缓存的键
+        self.version = hashlib.sha256(
+            json.dumps([rows, SEMANTIC_MAX_DISTANCE], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        for rule_id, doc, meta in rows:
+            context = meta.get("forbidden_in", "anywhere")
+            if meta.get("match", "exact") == "semantic":
+                self.semantic[context] = self.semantic.get(context, 0) + 1
+                continue
+            # 同一个 (动作, 场景) 有多条规则时取 id 最小的一条，保证结果确定
+            self.exact.setdefault((meta.get("action"), context), {
+                "id": rule_id,
+                "rule": doc,
+                "severity": meta.get("severity", "low"),
+            })
+
+    @classmethod
+    @perfde1.timed("rag.load_rules")
+    def from_collection(cls, collection) -> "RuleIndex":
+        data = collection.get(include=["documents", "metadatas"])
+        return cls(data["ids"], data["documents"], data["metadatas"])
+
+    def __len__(self) -> int:
+        return len(self.exact) + sum(self.semantic.values())
+
+    def lookup(self, action: str, context: str):
+        return self.exact.get((action, context))
+
+    def has_semantic(self, context: str) -> bool:
+        return context in self.semantic
+
+
+# anywhere 场景每个片段最多取回的语义规则候选数（没写 forbidden_in 的规则也算 anywhere，只能取回后再按场景过滤）
+SEMANTIC_TOP_K = 20
+
+
+def _semantic_where(context: str) -> dict:
+    if context == "anywhere":
+        return {"match": {"$eq": "semantic"}}
+    return {"$and": [{"match": {"$eq": "semantic"}}, {"forbidden_in": {"$eq": context}}]}
+
+
+@perfde1.timed("rag.semantic")
+def semantic_lookup_batch(collection, requests: list, rule_index: RuleIndex) -> dict:
+    """
+    批量语义检索：把 (代码片段, 场景) 请求去重后按场景分组，每个场景一次多查询，
+    查询时就按场景过滤，别的场景的规则不会把本场景的近邻挤出候选
+    返回 {(代码片段, 场景): 规则 或 None}
+    """
+    requests = list(dict.fromkeys(requests))
+    by_context = {}  # by_context: 场景 -> 该场景下要检索的代码片段
+    for snippet, context in requests:
+        by_context.setdefault(context, []).append(snippet)
+    best = {}  # best: (代码片段, 场景) -> 距离最近的规则
+    for context, snippets in by_context.items():
+        perfde1.incr("chroma.queries")
+        perfde1.incr("chroma.query_texts", len(snippets))
+        if context == "anywhere":
+            n_results = min(SEMANTIC_TOP_K, sum(rule_index.semantic.values()))
+        else:
+            n_results = 1
+        hits = collection.query(
+            query_texts=snippets,
+            where=_semantic_where(context),
+            n_results=max(1, n_results),
+            include=["documents", "metadatas", "distances"]
+        )
+        for snippet, ids, docs, metas, dists in zip(snippets, hits['ids'], hits['documents'],
+                                                    hits['metadatas'], hits['distances']):
+            # 候选按距离从近到远排列
+            for rule_id, doc, meta, dist in zip(ids, docs, metas, dists):
+                if dist > SEMANTIC_MAX_DISTANCE:
+                    break
+                if (meta or {}).get("forbidden_in", "anywhere") != context:
+                    continue
+                best[(snippet, context)] = {
+                    "id": rule_id,
+                    "rule": doc,
+                    "severity": meta.get('severity', 'low'),
+                }
+                break
+    return {key: best.get(key) for key in requests}
+
+
+@perfde1.timed("rag.exact")
+def match_exact(results,rule_index:RuleIndex,trace:list=None)->list:
+    """
+    第一阶段：只用内存规则索引做精确匹配，不访问数据库，可以放到子进程里跑
+    返回 [(代码片段, 场景, 规则或None)]，None 表示该场景有语义规则、等待第二阶段向量检索
+    trace: 传入列表时把每个调用点的匹配过程追加进去，由调用方按文件一次性输出
+    """
+    slots = []
+    # code_snippet: 代码片段（英文：code snippet - 代码片段，指当前检测到的函数调用代码）
+    # action_name: 动作名称（英文：action name - 动作名称，指函数调用的名称，如print、connect等）
+    # is_in_loop: 是否在循环中（英文：is in loop - 是否在循环中，布尔值，True表示当前代码在循环内）
+    # is_in_if: 是否在if语句中（英文：is in if - 是否在if语句中，布尔值，True表示当前代码在if分支内）
+    for code_snippet, action_name, is_in_loop, is_in_if in iter_call_records(results):
+        if trace is not None:
+            trace.append(f"call action={action_name} code={code_snippet!r} in_loop={is_in_loop} in_if={is_in_if}")
+        contexts = []  # contexts: 当前调用需要检查的场景
         if is_in_loop:
-            print("query in_loop")
-            # 检查循环中的规则
-            try:
-                # loop_results: 循环规则查询结果（英文：loop results - 循环规则的查询结果）
-                loop_results = collection.query(
-                    query_texts=[code_snippet],
-                    where={"$and": [{"action": {"$eq": action_name}}, {"forbidden_in": {"$eq": "loop"}}]},
-                    n_results=1
-                )
-                if loop_results['ids'][0]:
-                    rule_id = loop_results['ids'][0][0]  # rule_id: 规则ID（英文：rule ID - 规则的唯一标识符）
-                    rule_desc = loop_results['documents'][0][0]  # rule_desc: 规则描述（英文：rule description - 规则的详细描述）
-                    severity = loop_results['metadatas'][0][0]['severity']  # severity: 严重程度（英文：severity - 规则违规的严重程度，如low、high等）
-                    
-                    violations.append({
-                        "code": code_snippet,
-                        "rule": rule_desc,
-                        "severity": severity,
-                        "context": "loop"
-                    })
-                    print(f"    🚨 触发循环规则！{rule_desc}")
-            except Exception as e:
-                print(f"    ⚠️  查询循环规则时出错: {e}")
-        
+            contexts.append("loop")
         if is_in_if:
-            print("query in_if")
-            # 检查if中的规则
-            try:
-                # if_results: if规则查询结果（英文：if results - if规则的查询结果）
-                if_results = collection.query(
-                    query_texts=[code_snippet],
-                    where={"$and": [{"action": {"$eq": action_name}}, {"forbidden_in": {"$eq": "if"}}]},
-                    n_results=1
-                )
-                if if_results['ids'][0]:
-                    rule_id = if_results['ids'][0][0]
-                    rule_desc = if_results['documents'][0][0]
-                    severity = if_results['metadatas'][0][0]['severity']
-                    
-                    violations.append({
-                        "code": code_snippet,
-                        "rule": rule_desc,
-                        "severity": severity,
-                        "context": "if"
-                    })
-                    print(f"    🚨 触发if规则！{rule_desc}")
-            except Exception as e:
-                print(f"    ⚠️  查询if规则时出错: {e}")
-        
-        if not is_in_loop and not is_in_if:
-            print("all_query")
-            # 检查anywhere规则
-            try:
-                # anywhere_results: 任意位置规则查询结果（英文：anywhere results - 任意位置规则的查询结果）
-                anywhere_results = collection.query(
-                    query_texts=[code_snippet],
-                    where={"$and": [{"action": {"$eq": action_name}}, {"forbidden_in": {"$eq": "anywhere"}}]},
-                    n_results=1
-                )
-                if anywhere_results['ids'][0]:
-                    rule_id = anywhere_results['ids'][0][0]
-                    rule_desc = anywhere_results['documents'][0][0]
-                    severity = anywhere_results['metadatas'][0][0]['severity']
-                    
-                    violations.append({
-                        "code": code_snippet,
-                        "rule": rule_desc,
-                        "severity": severity,
-                        "context": "anywhere"
-                    })
-                    print(f"    🚨 触发anywhere规则！{rule_desc}")
-            except Exception as e:
-                print(f"    ⚠️  查询anywhere规则时出错: {e}")
-            print()      
-    return violations
+            contexts.append("if")
+        if not contexts:
+            contexts.append("anywhere")
+        for context in contexts:
+            # 先查精确规则：纯字典查找
+            rule = rule_index.lookup(action_name, context)
+            if rule is not None:
+                if trace is not None:
+                    trace.append(f"hit match=exact context={context} rule={rule['id']}")
+            elif rule_index.has_semantic(context):
+                # 精确规则没命中、且该场景有语义规则时，留给批量向量检索
+                pass
+            else:
+                continue
+            slots.append((code_snippet, context, rule))
+    return slots
+
+
+def format_report(fin_res: list) -> str:
+    """
+    把 rag_check 的违规列表整理成给人和 AI 看的文字报告
+    """
+    if not fin_res:
+        return "代码分析完成，未发现明显的违规问题。"
+
+    report = "发现以下代码违规问题：\n"
+    for v in fin_res:
+        report += f"- 代码片段: {v['code']}\n"
+        report += f"  触发场景: {v.get('context', 'unknown')}\n"
+        report += f"  严重程度: {v['severity']}\n"
+        report += f"  违规原因: {v['rule']}\n\n"
+
+    return report
+
+
+def resolve_slots(collection,slots_by_file:dict,rule_index:RuleIndex,traces:dict=None)->dict:
+    """
+    第二阶段：把所有文件里等待语义检索的调用点合并成一次批量检索，再生成每个文件的违规列表
+    每个文件输出一条 summary 级别的汇总日志；traces 给出 {文件名: 第一阶段的 trace 列表} 时，
+    再把该文件的全部匹配过程合成一条 trace 级别的日志
+    返回 {文件名: 违规列表}
+    """
+    # pending: 等待语义检索的 (代码片段, 场景)
+    pending = [(code_snippet, context)
+               for file_slots in slots_by_file.values()
+               for code_snippet, context, rule in file_slots if rule is None]
+    semantic = {}  # semantic: 批量语义检索的结果
+    if pending:
+        try:
+            semantic = semantic_lookup_batch(collection, pending, rule_index)
+        except Exception as e:
+            logde1.log(logger, logging.WARNING, "semantic_query_failed", error=e, snippets=len(pending))
+    report = {}
+    tracing = traces is not None and logger.isEnabledFor(logging.DEBUG)
+    for name, file_slots in slots_by_file.items():
+        violations = report[name] = []  # violations: 违规列表（英文：violations - 违规，存储检测到的所有违规情况）
+        trace = list(traces.get(name) or ()) if tracing else None
+        for code_snippet, context, rule in file_slots:
+            if rule is None:
+                rule = semantic.get((code_snippet, context))
+                if rule is None:
+                    continue
+                if trace is not None:
+                    trace.append(f"hit match=semantic context={context} rule={rule['id']} code={code_snippet!r}")
+            violations.append({
+                "code": code_snippet,
+                "rule": rule["rule"],
+                "severity": rule["severity"],
+                "context": context
+            })
+        logde1.log(logger, logging.INFO, "rag_check", file=name, candidates=len(file_slots),
+                   violations=len(violations), high=sum(1 for v in violations if v["severity"] == "high"))
+        if trace:
+            logde1.log(logger, logging.DEBUG, "rag_trace", trace, file=name)
+    return report
+
+
+@perfde1.timed("rag.check")
+def rag_check_batch(collection,results_by_file:dict,rule_index=None)->dict:
+    """
+    对一个文件或整个 PR 的多个文件做规则匹配
+    results_by_file: {文件名: 调用点索引或AST分析结果列表}
+    精确规则直接查字典；需要语义检索的调用点先收集起来，最后统一做一次批量检索再分发回去
+    日志级别为 trace 时才记录逐个调用点的匹配过程，否则每个文件只有一行汇总
+    返回 {文件名: 违规列表}
+    """
+    if rule_index is None:
+        rule_index = RuleIndex.from_collection(collection)
+    traces = {name: [] for name in results_by_file} if logger.isEnabledFor(logging.DEBUG) else None
+    slots = {name: match_exact(results, rule_index, traces[name] if traces is not None else None)
+             for name, results in results_by_file.items()}
+    report = resolve_slots(collection, slots, rule_index, traces)
+    perfde1.incr("rag.files", len(report))
+    perfde1.incr("rag.violations", sum(len(violations) for violations in report.values()))
+    return report
+
+
+def rag_check(collection,results,rule_index=None):
+    # collection: ChromaDB集合对象（英文：collection - 集合，这里指存储规则的数据库集合）
+    # results: 调用点索引或AST分析结果列表（英文：results - 结果，这里指AST解析后得到的代码结构信息）
+    # rule_index: 内存规则索引，不传时从 collection 现场加载一次
+    return rag_check_batch(collection, {None: results}, rule_index)[None]
+
+
+class RuleStore:
+    """
+    进程级的规则库句柄
+    第一次使用时才打开 PersistentClient、创建嵌入函数并加载规则索引，之后所有审查共用同一份；
+    初始化和重建都在锁里完成，规则索引本身只读，多个线程可以同时做 rag_check
+    """
+    def __init__(self, path: str = "./demodb.db") -> None:
+        self.path = path
+        self._lock = threading.RLock()
+        self._collection = None
+        self._rule_index = None
+        self.embedding_function = None
+
+    def open(self) -> "RuleStore":
+        if self._collection is None:
+            with self._lock:
+                if self._collection is None:
+                    self.embedding_function = cachede1.cached_default_ef()
+                    collection = init_rag_db(self.path, self.embedding_function)
+                    self._rule_index = RuleIndex.from_collection(collection)
+                    self._collection = collection
+        return self
+
+    def warm_up(self) -> None:
+        """
+        提前加载嵌入模型（绕过缓存直接嵌入一次），避免第一条语义检索承担模型加载时间
+        嵌入函数在锁里取，不会和 close() 交错拿到 None；加载模型本身在锁外做，不挡住其他线程的检查
+        """
+        with self._lock:
+            embedding_function = self.open().embedding_function
+        embedding_function.inner(["print(x)"])
+
+    @property
+    def collection(self):
+        # 在锁里取，不会和 close() 交错拿到 None
+        with self._lock:
+            return self.open()._collection
+
+    @property
+    def rule_index(self) -> RuleIndex:
+        with self._lock:
+            return self.open()._rule_index
+
+    def reload(self) -> None:
+        """
+        规则库内容变了之后重建内存规则索引
+        """
+        with self._lock:
+            self._rule_index = RuleIndex.from_collection(self.collection)
+
+    def health_check(self) -> bool:
+        """
+        检查句柄是否可用；数据库访问失败时关闭句柄，下次使用会重新初始化
+        """
+        try:
+            count = self.collection.count()
+        except Exception as e:
+            logde1.log(logger, logging.WARNING, "health_check_failed", path=self.path, error=e)
+            self.close()
+            return False
+        # 和加载时的记录条数比，不和去重后的索引大小比（有重复规则时两者永远不相等）
+        if count != self.rule_index.source_count:
+            self.reload()
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._collection = None
+            self._rule_index = None
+            self.embedding_function = None
+
+    def check(self, results) -> list:
+        return rag_check_batch(self.collection, {None: results}, self.rule_index)[None]
+
+    def check_batch(self, results_by_file: dict) -> dict:
+        return rag_check_batch(self.collection, results_by_file, self.rule_index)
+
+
+_rule_stores = {}  # path -> RuleStore
+_rule_stores_lock = threading.Lock()
+
+
+def get_rule_store(path: str = "./demodb.db") -> RuleStore:
+    """
+    返回进程里共享的规则库句柄（按路径区分），按需初始化
+    """
+    with _rule_stores_lock:
+        store = _rule_stores.get(path)
+        if store is None:
+            store = _rule_stores[path] = RuleStore(path)
+    return store.open()
+
+
 # def get_or_create():
 #     if 
 
 if __name__ == "__main__":
+    # 日志级别由环境变量 CODEREVIEW_LOG 控制，设为 trace 可以看到每个调用点的匹配过程
+    logde1.configure()
     # 0. 初始化数据库
     collection = init_rag_db()
     
@@ -198,7 +453,7 @@ def example():
     print("=" * 60)
     print("第一步：AST 解析代码结构")
     print("=" * 60)
-    results = astde1.analyze_code(sample_code)
+    results = astde1.extract_calls(sample_code)
     
     # 2. RAG 检查
     print("\n" + "=" * 60)
@@ -216,4 +471,5 @@ def example():
             print(f"        触发场景: {v['context']}")
             print(f"        违规原因: {v['rule']}\n")
     else:
-        print("代码完美，没有发现问题！")
\ No newline at end of file
+        print("代码完美，没有发现问题！")
+    print(f"嵌入缓存: {cachede1.get_embedding_cache().stats()}")
\ No newline at end of file
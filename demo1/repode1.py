@@ -0,0 +1,206 @@
+import argparse
+import contextlib
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import astde1
+import cachede1
+import logde1
+import perfde1
+import ragde1
+
+# 遍历仓库时跳过的目录
+SKIP_DIRS = {".git", ".hg", ".svn", "__pycache__", ".venv", "venv", "env", "node_modules",
+             ".tox", ".nox", ".mypy_cache", ".pytest_cache", "build", "dist"}
+
+
+def iter_python_files(root: str):
+    """
+    遍历目录树，产出所有 .py 文件路径
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS and not d.endswith(".db"))
+        for filename in sorted(filenames):
+            if filename.endswith(".py"):
+                yield os.path.join(dirpath, filename)
+
+
+# 子进程里的只读规则索引和是否记录匹配过程，由进程池 initializer 设置一次
+_worker_rule_index = None
+_worker_trace = False
+
+
+def _init_worker(rule_index: ragde1.RuleIndex, trace: bool = False) -> None:
+    global _worker_rule_index, _worker_trace
+    _worker_rule_index = rule_index
+    _worker_trace = trace
+    # fork 出来的子进程带着主进程的指标副本，清零后只记自己的
+    perfde1.METRICS.reset()
+
+
+def _analyze_file(path: str, code: str = None, keep_calls: bool = False) -> dict:
+    """
+    单个文件：读取、抽取调用点并做精确规则匹配（CPU 密集，在子进程里跑）
+    keep_calls=True 时把调用点记录一并带回，用于写增量缓存
+    """
+    try:
+        if code is None:
+            with open(path, encoding="utf-8") as f:
+                code = f.read()
+        calls = astde1.extract_calls(code)
+    except (OSError, UnicodeDecodeError, SyntaxError, ValueError) as e:
+        return {"path": path, "calls": 0, "slots": [], "records": None, "trace": None,
+                "error": f"{type(e).__name__}: {e}"}
+    trace = [] if _worker_trace else None
+    return {
+        "path": path,
+        "calls": len(calls),
+        "slots": ragde1.match_exact(calls, _worker_rule_index, trace),
+        "records": [site.to_dict() for site in calls] if keep_calls else None,
+        "trace": trace,
+        "error": None,
+    }
+
+
+def _analyze_chunk(jobs: list, keep_calls: bool) -> tuple:
+    """
+    返回 (每个文件的结果, 这一块在子进程里记下的指标)，指标由主进程合并
+    """
+    results = [_analyze_file(path, code, keep_calls) for path, code in jobs]
+    return results, perfde1.METRICS.drain()
+
+
+def _chunk_results(future) -> list:
+    results, metrics = future.result()
+    perfde1.METRICS.merge(metrics)
+    return results
+
+
+def review_repository(root: str, store: ragde1.RuleStore = None, workers: int = None, chunk_size: int = 16,
+                      cache: cachede1.ReviewCache = None):
+    """
+    仓库模式：把文件按块分给进程池做 AST 解析和精确匹配，
+    语义规则在主进程里按块批量检索，每个文件的结果一完成就产出
+    传入 cache 时按 (文件内容哈希, 规则集版本) 增量审查：
+    - 内容、规则和分析器版本都没变的文件直接用缓存里的违规列表
+    - 只是规则变了的文件复用缓存的调用点，只重新匹配，不重新解析
+    产出 {"path", "calls", "violations", "error", "cached"}
+    """
+    if store is None:
+        store = ragde1.get_rule_store()
+    rule_index = store.rule_index
+    workers = workers or os.cpu_count() or 1
+    digests = {}  # digests: 路径 -> 内容哈希，只在启用缓存时记录
+    # 匹配过程在子进程里记录，带回主进程按文件输出
+    trace = ragde1.logger.isEnabledFor(logging.DEBUG)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rule_index, trace)) as pool:
+        # 同时在途的块数有上限，避免一次把整个仓库的任务都塞进队列
+        running = set()
+        chunk = []
+        for path in iter_python_files(root):
+            code = None
+            if cache is not None:
+                try:
+                    with open(path, "rb") as f:
+                        content = f.read()
+                    code = content.decode("utf-8")
+                except (OSError, UnicodeDecodeError) as e:
+                    yield {"path": path, "calls": 0, "violations": [],
+                           "error": f"{type(e).__name__}: {e}", "cached": False}
+                    continue
+                digest = digests[path] = cachede1.ReviewCache.digest(content)
+                violations = cache.get_review(digest, rule_index.version, astde1.ANALYZER_VERSION)
+                if violations is not None:
+                    yield {"path": path, "calls": None, "violations": violations, "error": None, "cached": True}
+                    continue
+                records = cache.get_analysis(digest, astde1.ANALYZER_VERSION)
+                if records is not None:
+                    # 调用点还在缓存里，只需要按新规则重新匹配（纯字典查找，主进程里做就行）
+                    records_trace = [] if trace else None
+                    result = {"path": path, "calls": len(records), "records": None, "error": None,
+                              "slots": ragde1.match_exact(records, rule_index, records_trace),
+                              "trace": records_trace}
+                    yield from _finish_chunk(store, rule_index, [result], cache, digests)
+                    continue
+            chunk.append((path, code))
+            if len(chunk) < chunk_size:
+                continue
+            running.add(pool.submit(_analyze_chunk, chunk, cache is not None))
+            chunk = []
+            if len(running) < workers * 2:
+                continue
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from _finish_chunk(store, rule_index, _chunk_results(future), cache, digests)
+        if chunk:
+            running.add(pool.submit(_analyze_chunk, chunk, cache is not None))
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from _finish_chunk(store, rule_index, _chunk_results(future), cache, digests)
+
+
+def _finish_chunk(store: ragde1.RuleStore, rule_index: ragde1.RuleIndex, results: list,
+                  cache: cachede1.ReviewCache = None, digests: dict = None):
+    slots = {result["path"]: result["slots"] for result in results}
+    traces = {result["path"]: result["trace"] for result in results}
+    report = ragde1.resolve_slots(store.collection, slots, rule_index, traces)
+    for result in results:
+        violations = report[result["path"]]
+        digest = digests.pop(result["path"], None)
+        if cache is not None and result["error"] is None:
+            if result["records"] is not None:
+                cache.put_analysis(digest, astde1.ANALYZER_VERSION, result["records"])
+            cache.put_review(digest, rule_index.version, astde1.ANALYZER_VERSION, violations)
+        yield {
+            "path": result["path"],
+            "calls": result["calls"],
+            "violations": violations,
+            "error": result["error"],
+            "cached": False,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="并行审查整个仓库")
+    parser.add_argument("root", help="仓库根目录")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="进程数，默认等于 CPU 核数")
+    parser.add_argument("--chunk-size", type=int, default=16, help="每个任务包含的文件数")
+    parser.add_argument("--cache", default=cachede1.DEFAULT_REVIEW_CACHE, help="增量审查缓存路径")
+    parser.add_argument("--no-cache", action="store_true", help="关闭增量审查，所有文件都重新分析")
+    parser.add_argument("--metrics", choices=["json", "prometheus"], help="结束时按这个格式输出各阶段指标")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="FILE",
+                        help="用 cProfile 剖析主进程，给了 FILE 时把数据写进文件")
+    parser.add_argument("--trace-memory", action="store_true", help="用 tracemalloc 统计主进程的内存分配")
+    logde1.add_arguments(parser)
+    args = parser.parse_args()
+    logde1.configure_from_args(args)
+
+    cache = None if args.no_cache else cachede1.ReviewCache(args.cache)
+    start = time.perf_counter()
+    files = calls = violations = errors = skipped = 0
+    profiling = args.profile is not None or args.trace_memory
+    with perfde1.profile(args.profile or None, args.trace_memory) if profiling else contextlib.nullcontext():
+        for result in review_repository(args.root, workers=args.workers, chunk_size=args.chunk_size, cache=cache):
+            files += 1
+            if result["cached"]:
+                skipped += 1
+            else:
+                calls += result["calls"]
+            if result["error"]:
+                errors += 1
+                print(f"❌ {result['path']}: {result['error']}")
+            elif result["violations"]:
+                violations += len(result["violations"])
+                print(f"📄 {result['path']}")
+                print(ragde1.format_report(result["violations"]))
+    elapsed = time.perf_counter() - start
+    print("=" * 60)
+    print(f"共审查 {files} 个文件（{skipped} 个未变化直接跳过），{calls} 个调用点，"
+          f"发现 {violations} 处违规，{errors} 个文件无法解析，耗时 {elapsed:.2f}s")
+    if args.metrics == "json":
+        print(perfde1.METRICS.to_json())
+    elif args.metrics == "prometheus":
+        print(perfde1.METRICS.to_prometheus(), end="")
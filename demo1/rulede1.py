@@ -0,0 +1,301 @@
+import ast
+
+import astde1
+import perfde1
+
+# 环境标志位：节点外层有哪些控制结构，和 astde1 的环境名一一对应
+_CONTEXT_BITS = {ast.For: 1, ast.While: 2, ast.AsyncFor: 4, ast.If: 8}
+_CONTEXT_KINDS = {ast.For: "For", ast.While: "While", ast.AsyncFor: "AsyncFor", ast.If: "If"}
+_FLAG_COMBINATIONS = 16
+
+# 规则 contexts 里可以写的环境名 -> 标志位掩码；anywhere 表示不在任何循环和 if 里
+CONTEXT_MASKS = {"For": 1, "While": 2, "AsyncFor": 4, "loop": 7, "If": 8, "if": 8}
+ANYWHERE = "anywhere"
+
+_FUNCTION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+class Rule:
+    """
+    规则基类，子类声明自己关心什么，由 RuleEngine 在一次遍历里分发节点：
+    - node_types: 关心的 AST 节点类型（写基类时包括所有子类，比如 ast.stmt）
+    - actions:    只关心这些动作名的调用（如 "connect"），写了就不用再写 node_types，
+                  引擎按动作名直接查表，同一种节点上挂几百条调用规则也不会逐条判断
+    - contexts:   只在这些环境里触发，如 ("loop",)、("If",)、("anywhere",)；空表示不限
+    子类实现 visit(node, state)，需要按文件汇总的规则再实现 begin / end
+    """
+    id = None
+    node_types = ()
+    actions = ()
+    contexts = ()
+    severity = "low"
+    message = ""
+
+    def begin(self, state: "RuleState") -> None:
+        pass
+
+    def visit(self, node: ast.AST, state: "RuleState") -> None:
+        raise NotImplementedError
+
+    def end(self, state: "RuleState"):
+        """
+        返回这条规则对整个文件的汇总（比如统计数据），没有汇总时返回 None
+        """
+        return None
+
+    def accepts(self, flags: int) -> bool:
+        return not self.contexts or self.matched_context(flags) is not None
+
+    def matched_context(self, flags: int):
+        """
+        contexts 里第一个和环境标志位对得上的环境名，都对不上时返回 None
+        """
+        for context in self.contexts:
+            if context == ANYWHERE:
+                if flags == 0:
+                    return context
+            elif flags & CONTEXT_MASKS[context]:
+                return context
+        return None
+
+
+class RuleState:
+    """
+    一个文件的遍历状态：规则在 visit 里通过它读当前环境、切源码、报告问题
+    - context:  当前节点外层的控制结构，从外到内，如 ("If", "For")
+    - function: 当前节点所在函数的限定名，模块级为 None
+    - data:     规则 id -> 这条规则在这个文件里的私有数据
+    """
+    __slots__ = ("source", "context", "function", "findings", "data")
+
+    def __init__(self, code: str) -> None:
+        self.source = astde1._SourceText(code)
+        self.context = ()
+        self.function = None
+        self.findings = []
+        self.data = {}
+
+    def segment(self, node: ast.AST) -> str:
+        return self.source.segment(node.lineno, node.col_offset, node.end_lineno, node.end_col_offset)
+
+    def context_name(self) -> str:
+        """
+        违规记录里的场景名，和 ragde1 一样取 loop / if / anywhere
+        """
+        if any(kind != "If" for kind in self.context):
+            return "loop"
+        if self.context:
+            return "if"
+        return ANYWHERE
+
+    def report(self, rule: Rule, node: ast.AST, message: str = None, context: str = None) -> None:
+        """
+        记录一条违规，格式兼容 rag_check 的违规列表（可以直接交给 ragde1.format_report）
+        """
+        self.findings.append({
+            "id": rule.id,
+            "code": self.segment(node),
+            "rule": message or rule.message,
+            "severity": rule.severity,
+            "context": context or self.context_name(),
+            "lineno": node.lineno,
+            "function": self.function,
+        })
+
+
+def _node_classes(node_type) -> list:
+    """
+    节点类型连同它的所有子类（写 ast.stmt 就等于写了所有语句类型）
+    """
+    classes, stack = [], [node_type]
+    while stack:
+        cls = stack.pop()
+        classes.append(cls)
+        stack.extend(cls.__subclasses__())
+    return classes
+
+
+class RuleEngine:
+    """
+    多规则、单次遍历的规则引擎
+    构造时把每条规则按 (节点类型, 环境标志位) 和 (调用动作名, 环境标志位) 展开成分发表，
+    遍历时每个节点只查一次表，拿到的就是真正要执行的规则；
+    总开销是 O(节点数 + 命中次数)，和规则条数无关
+    """
+    def __init__(self, rules: list) -> None:
+        self.rules = list(rules)
+        by_type, by_action = {}, {}
+        for rule in self.rules:
+            accepted = [flags for flags in range(_FLAG_COMBINATIONS) if rule.accepts(flags)]
+            if rule.actions:
+                for action in rule.actions:
+                    for flags in accepted:
+                        by_action.setdefault((action, flags), []).append(rule)
+                continue
+            for node_type in rule.node_types:
+                for cls in _node_classes(node_type):
+                    for flags in accepted:
+                        handlers = by_type.setdefault((cls, flags), [])
+                        if rule not in handlers:
+                            handlers.append(rule)
+        # _by_type: (节点类, 标志位) -> 规则元组；_by_action: (动作名, 标志位) -> 规则元组
+        self._by_type = {key: tuple(rules) for key, rules in by_type.items()}
+        self._by_action = {key: tuple(rules) for key, rules in by_action.items()}
+
+    @perfde1.timed("rule.run")
+    def run(self, code: str) -> dict:
+        """
+        遍历一次代码，把每个节点交给关心它的规则
+        返回 {"findings": 违规列表（按遍历顺序）, "summaries": {规则 id: 汇总}}
+        代码无法解析时抛出 SyntaxError
+        """
+        tree = ast.parse(code)
+        state = RuleState(code)
+        for rule in self.rules:
+            rule.begin(state)
+        by_type, by_action = self._by_type, self._by_action
+        # stack: 待访问的 (节点, 环境栈, 环境标志位, 所在函数, 限定名前缀)
+        stack = [(tree, (), 0, None, "")]
+        while stack:
+            node, context, flags, function, prefix = stack.pop()
+            node_type = type(node)
+            handlers = by_type.get((node_type, flags))
+            if node_type is ast.Call and by_action:
+                called = by_action.get((astde1.call_name(node)[1], flags))
+                if called:
+                    handlers = handlers + called if handlers else called
+            if handlers:
+                state.context = context
+                state.function = function
+                for rule in handlers:
+                    rule.visit(node, state)
+            bit = _CONTEXT_BITS.get(node_type)
+            if bit is not None:
+                context = context + (_CONTEXT_KINDS[node_type],)
+                flags |= bit
+            if node_type in _FUNCTION_TYPES:
+                function = prefix + node.name
+                prefix = function + "."
+            elif node_type is ast.ClassDef:
+                prefix = prefix + node.name + "."
+            children = list(ast.iter_child_nodes(node))
+            for child in reversed(children):
+                stack.append((child, context, flags, function, prefix))
+        summaries = {}
+        for rule in self.rules:
+            summary = rule.end(state)
+            if summary is not None:
+                summaries[rule.id] = summary
+        return {"findings": state.findings, "summaries": summaries}
+
+
+class CallInContextRule(Rule):
+    """
+    在指定环境里调用了指定动作就报告，比如循环里的 connect / print
+    """
+    def __init__(self, id: str, actions, contexts, message: str, severity: str = "low") -> None:
+        self.id = id
+        self.actions = tuple(actions)
+        self.contexts = tuple(contexts)
+        self.message = message
+        self.severity = severity
+
+    def visit(self, node, state):
+        # 同时在 if 和循环里时报告规则自己写的那个环境
+        context = next((c for c in self.contexts if _in_context(c, state.context)), None)
+        state.report(self, node, context=context)
+
+
+# 环境名 -> 它包括的控制结构
+_CONTEXT_KIND_GROUPS = {"For": ("For",), "While": ("While",), "AsyncFor": ("AsyncFor",),
+                        "loop": ("For", "While", "AsyncFor"), "If": ("If",), "if": ("If",)}
+
+
+def _in_context(name: str, context: tuple) -> bool:
+    if name == ANYWHERE:
+        return not context
+    return any(kind in _CONTEXT_KIND_GROUPS[name] for kind in context)
+
+
+class SwallowedExceptionRule(Rule):
+    """
+    裸 except 和只有 pass 的 except Exception
+    """
+    id = "swallowed_exception"
+    node_types = (ast.ExceptHandler,)
+    severity = "medium"
+    message = "异常被直接吞掉，出错时没有任何记录，至少应该记日志或只捕获具体的异常类型。"
+
+    def visit(self, node, state):
+        if node.type is None:
+            state.report(self, node)
+        elif isinstance(node.type, ast.Name) and node.type.id in ("Exception", "BaseException") \
+                and all(isinstance(stmt, ast.Pass) for stmt in node.body):
+            state.report(self, node)
+
+
+class ControlFlowRule(Rule):
+    """
+    控制流统计（原来 ast.stu.py 里的 ControlFlowVisitor）：if / try / 循环的数量和捕获的异常类型
+    """
+    id = "control_flow"
+    node_types = (ast.If, ast.Try, ast.For, ast.While, ast.AsyncFor)
+
+    def begin(self, state):
+        state.data[self.id] = {"if_count": 0, "try_count": 0, "loop_count": 0, "except_handlers": []}
+
+    def visit(self, node, state):
+        data = state.data[self.id]
+        if isinstance(node, ast.If):
+            data["if_count"] += 1
+        elif isinstance(node, ast.Try):
+            data["try_count"] += 1
+            for handler in node.handlers:
+                if isinstance(handler.type, ast.Name):
+                    data["except_handlers"].append(handler.type.id)
+        else:
+            data["loop_count"] += 1
+
+    def end(self, state):
+        return state.data[self.id]
+
+
+class FingerprintRule(Rule):
+    """
+    代码指纹（原来 ast.stu.py 里的 CodeFingerprintExtractor 和 ontest.py 里的 fenxi）：
+    导入的库、定义的函数、调用的动作
+    """
+    id = "fingerprint"
+    node_types = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.Call)
+
+    def begin(self, state):
+        state.data[self.id] = {"imports": [], "functions": [], "function_calls": []}
+
+    def visit(self, node, state):
+        data = state.data[self.id]
+        if isinstance(node, ast.Import):
+            data["imports"].extend(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.module:
+                data["imports"].append(node.module.split(".")[0])
+        elif isinstance(node, ast.Call):
+            data["function_calls"].append(astde1.call_name(node)[1])
+        else:
+            data["functions"].append(node.name)
+
+    def end(self, state):
+        data = state.data[self.id]
+        return {**data, "libraries_used": sorted(set(data["imports"]))}
+
+
+def default_rules() -> list:
+    return [SwallowedExceptionRule(), ControlFlowRule(), FingerprintRule()]
+
+
+def rules_from_index(rule_index) -> list:
+    """
+    把 ragde1.RuleIndex 里的精确规则转成调用规则，和 match_exact 的判断一致
+    （语义规则要走向量检索，不在这里）
+    """
+    return [CallInContextRule(rule["id"], [action], [context], rule["rule"], rule["severity"])
+            for (action, context), rule in rule_index.exact.items()]
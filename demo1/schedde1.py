@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+
+import aide1
+import astde1
+import cachede1
+import ctxde1
+import logde1
+import perfde1
+import ragde1
+import repode1
+import triagede1
+
+# 结束标记：每个消费者退出时放一个
+_DONE = object()
+
+
+def default_concurrency() -> int:
+    """
+    默认并发数和本地 Ollama 服务的并行度保持一致（OLLAMA_NUM_PARALLEL）
+    """
+    try:
+        return max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", "4")))
+    except ValueError:
+        return 4
+
+
+class ReviewScheduler:
+    """
+    基于 asyncio 的 AI 审核调度器
+    - AST/RAG 阶段在线程池里跑，结果放进有界队列；队列满时上游自动等待（背压）
+    - concurrency 个消费者并发调用 ainvoke，正好占满 LLM 后端的并行度
+    - 每次模型调用（包括大文件的每一块）占到名额后单独计时，失败后按指数退避加随机抖动只重试这一次调用
+    - batch > 1 时把相邻的小文件攒成一组，用一个批量请求审核
+    - 分诊策略判断不需要复核的文件直接返回 RAG 报告，不占 LLM 并发
+    """
+    def __init__(self, model=None, concurrency: int = None, timeout: float = 120.0, retries: int = 2,
+                 backoff: float = 1.0, store: ragde1.RuleStore = None,
+                 llm_cache: cachede1.LLMResponseCache = None, batch: int = 1,
+                 triage: triagede1.TriagePolicy = triagede1.DEFAULT_POLICY) -> None:
+        # reviewer: 所有并发请求共用一个审核器（同一个模型客户端和审核链）
+        if model is None:
+            self.reviewer = aide1.get_reviewer(deterministic=llm_cache is not None)
+        else:
+            self.reviewer = aide1.as_reviewer(model)
+        self.concurrency = concurrency or default_concurrency()
+        self.timeout = timeout        # timeout: 单次模型调用的超时时间（秒）
+        self.retries = retries        # retries: 失败后最多重试的次数
+        self.backoff = backoff        # backoff: 第一次重试前等待的秒数，之后每次翻倍
+        self.store = store if store is not None else ragde1.get_rule_store()
+        self.llm_cache = llm_cache    # llm_cache: 可选的回答缓存，命中时不调用模型
+        self.batch = max(1, batch)    # batch: 一个批量请求最多包含的文件数
+        self.triage = triage          # triage: 分诊策略，None 表示每个文件都调用模型
+
+    def _prepare(self, name: str, code: str = None) -> dict:
+        """
+        读取文件 + AST 解析 + 规则匹配（同步，在线程池里跑）
+        code 为 None 时按 name 读取文件；读不出来或解析失败时返回带 error 的任务，不影响其他文件
+        """
+        try:
+            if code is None:
+                with open(name, encoding="utf-8") as f:
+                    code = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            return {"name": name, "code": code, "error": f"文件无法读取: {type(e).__name__}: {e}"}
+        try:
+            calls = astde1.extract_calls(code)
+            violations = self.store.check(calls)
+        except (SyntaxError, ValueError) as e:
+            return {"name": name, "code": code, "error": f"代码无法解析: {e}"}
+        if self.triage is None:
+            decision = {"needed": True, "reasons": []}
+        else:
+            decision = triagede1.triage(code, violations, calls, self.triage)
+        return {"name": name, "code": code, "violations": violations,
+                "report": aide1.format_report(violations), "triage": decision, "error": None}
+
+    @staticmethod
+    def _new_result(job: dict) -> dict:
+        return {
+            "name": job["name"],
+            "violations": job.get("violations", []),
+            "report": job.get("report"),
+            "review": None,
+            "error": job["error"],
+            "attempts": 0,
+            "skipped": not job["error"] and not job["triage"]["needed"],
+        }
+
+    def _cached(self, job: dict, result: dict):
+        """
+        查回答缓存，命中时直接填进 result；返回缓存键（没开缓存时为 None）
+        """
+        if self.llm_cache is None:
+            return None
+        key = aide1.review_cache_key(job["code"], job["violations"], self.reviewer.model_name)
+        result["review"] = self.llm_cache.get(key)
+        return key
+
+    def _limits(self, slots: asyncio.Semaphore = None) -> aide1.CallLimits:
+        """
+        一个文件（或一组文件）的调用限制：共用 slots，每次模型调用单独超时、单独重试
+        """
+        return aide1.CallLimits(slots, self.timeout, self.retries, self.backoff)
+
+    @staticmethod
+    def _error(e: Exception) -> str:
+        return f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+
+    async def _review(self, job: dict, slots: asyncio.Semaphore = None) -> dict:
+        result = self._new_result(job)
+        if job["error"] or result["skipped"]:
+            return result
+        key = self._cached(job, result)
+        if result["review"] is not None:
+            return result
+        limits = self._limits(slots)
+        try:
+            result["review"] = await self.reviewer.areview_file(job["code"], job["violations"], limits=limits)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result["error"] = self._error(e)
+        result["attempts"] = limits.attempts
+        if key is not None and result["review"] is not None:
+            self.llm_cache.put(key, self.reviewer.model_name, result["review"])
+        return result
+
+    async def _review_group(self, jobs: list, slots: asyncio.Semaphore = None) -> list:
+        """
+        一组小文件：缓存命中的直接返回，其余的放进一个批量请求
+        slots: 模型调用的并发名额，大文件分块审核时每块各占一个
+        """
+        if len(jobs) == 1:
+            return [await self._review(jobs[0], slots)]
+        results = [self._new_result(job) for job in jobs]
+        pending = []  # pending: (结果, 任务, 缓存键)，需要调用模型的
+        for result, job in zip(results, jobs):
+            if job["error"] or result["skipped"]:
+                continue
+            key = self._cached(job, result)
+            if result["review"] is None:
+                pending.append((result, job, key))
+        if not pending:
+            return results
+        files = [(job["name"], job["code"], job["violations"]) for _, job, _ in pending]
+        limits = self._limits(slots)
+        reviews, error = None, None
+        try:
+            reviews = await self.reviewer.areview_batch(files, limits=limits)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = self._error(e)
+        for n, (result, job, key) in enumerate(pending):
+            result["attempts"] = limits.attempts
+            result["error"] = error
+            if reviews is not None:
+                result["review"] = reviews[n]
+                if key is not None:
+                    self.llm_cache.put(key, self.reviewer.model_name, reviews[n])
+        return results
+
+    async def run(self, jobs):
+        """
+        jobs: 可迭代的 (名称, 代码)，代码为 None 时在线程池里按名称读取文件
+        异步产出每个文件的结果，谁先完成先产出：
+        {"name", "violations", "report", "review", "error", "attempts", "skipped"}
+        skipped=True 表示分诊认为不需要 AI 复核，review 为 None
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results = asyncio.Queue()
+        # slots: 所有消费者共用的模型调用名额，文件分成多块时在途请求数也不超过 concurrency
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def produce():
+            group = []  # group: 攒着等待批量审核的小文件
+            try:
+                for name, code in jobs:
+                    job = await loop.run_in_executor(None, self._prepare, name, code)
+                    # 队列满说明 LLM 跟不上，put 会等到有空位再继续解析下一个文件
+                    if self.batch > 1 and not job["error"] and job["triage"]["needed"] and \
+                            ctxde1.file_tokens(job["code"], job["violations"]) <= ctxde1.DEFAULT_TOKEN_BUDGET // 2:
+                        group.append(job)
+                        if len(group) >= self.batch:
+                            await queue.put(group)
+                            group = []
+                    else:
+                        await queue.put([job])
+                if group:
+                    await queue.put(group)
+            finally:
+                for _ in range(self.concurrency):
+                    await queue.put(None)
+
+        async def consume():
+            try:
+                while True:
+                    group = await queue.get()
+                    if group is None:
+                        break
+                    for result in await self._review_group(group, slots):
+                        await results.put(result)
+            finally:
+                await results.put(_DONE)
+
+        producer = asyncio.create_task(produce())
+        consumers = [asyncio.create_task(consume()) for _ in range(self.concurrency)]
+        try:
+            remaining = len(consumers)
+            while remaining:
+                item = await results.get()
+                if item is _DONE:
+                    remaining -= 1
+                    continue
+                yield item
+            await producer
+        finally:
+            for task in [producer, *consumers]:
+                task.cancel()
+
+
+def _read_jobs(paths: list):
+    """
+    展开要审查的文件，内容留给 _prepare 在线程池里读取，不阻塞事件循环
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = repode1.iter_python_files(path)
+        else:
+            files = [path]
+        for file in files:
+            yield file, None
+
+
+async def _main(args) -> None:
+    llm_cache = None if args.no_cache else cachede1.LLMResponseCache()
+    triage = None if args.no_triage else triagede1.TriagePolicy(min_severity=args.min_severity)
+    scheduler = ReviewScheduler(concurrency=args.concurrency, timeout=args.timeout, retries=args.retries,
+                                llm_cache=llm_cache, batch=args.batch, triage=triage)
+    print(f"🚀 并发数: {scheduler.concurrency}, 超时: {scheduler.timeout}s, 重试: {scheduler.retries} 次")
+    start = time.perf_counter()
+    count = 0
+    async for result in scheduler.run(_read_jobs(args.paths)):
+        count += 1
+        print("=" * 60)
+        print(f"📄 {result['name']} (尝试 {result['attempts']} 次)")
+        print(result["report"] or "")
+        if result["error"]:
+            print(f"❌ {result['error']}")
+        elif result["skipped"]:
+            print("✅ 没有需要 AI 复核的问题，跳过 AI 审核")
+        else:
+            print("🤖 AI审核意见:")
+            print(result["review"])
+    print("=" * 60)
+    print(f"共审查 {count} 个文件，耗时 {time.perf_counter() - start:.2f}s")
+    if args.metrics == "json":
+        print(perfde1.METRICS.to_json())
+    elif args.metrics == "prometheus":
+        print(perfde1.METRICS.to_prometheus(), end="")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="并发 AI 审核多个文件")
+    parser.add_argument("paths", nargs="+", help="要审查的文件或目录")
+    parser.add_argument("-c", "--concurrency", type=int, default=None,
+                        help="并发调用 LLM 的数量，默认 OLLAMA_NUM_PARALLEL 或 4")
+    parser.add_argument("--timeout", type=float, default=120.0, help="单次 LLM 调用超时（秒）")
+    parser.add_argument("--retries", type=int, default=2, help="失败重试次数")
+    parser.add_argument("--no-cache", action="store_true", help="关闭确定性模式和回答缓存")
+    parser.add_argument("--batch", type=int, default=1, help="把最多这么多个小文件放进一个请求审核，默认 1（不批量）")
+    parser.add_argument("--no-triage", action="store_true", help="关闭分诊，每个文件都调用 LLM")
+    parser.add_argument("--min-severity", default="high", choices=sorted(triagede1.SEVERITY_LEVELS),
+                        help="达到这个严重程度的违规才一定交给 LLM 复核")
+    parser.add_argument("--metrics", choices=["json", "prometheus"], help="结束时按这个格式输出各阶段指标")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="FILE",
+                        help="用 cProfile 剖析整个运行过程，给了 FILE 时把数据写进文件")
+    parser.add_argument("--trace-memory", action="store_true", help="用 tracemalloc 统计内存分配")
+    logde1.add_arguments(parser)
+    args = parser.parse_args()
+    logde1.configure_from_args(args)
+    profiling = args.profile is not None or args.trace_memory
+    with perfde1.profile(args.profile or None, args.trace_memory) if profiling else contextlib.nullcontext():
+        asyncio.run(_main(args))
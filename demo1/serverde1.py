@@ -0,0 +1,188 @@
+import argparse
+import json
+import logging
+import os
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aide1
+import astde1
+import cachede1
+import logde1
+import perfde1
+import ragde1
+import triagede1
+
+logger = logde1.get_logger("server")
+
+
+class ReviewService:
+    """
+    常驻的审查服务：规则索引、嵌入模型和 LLM 客户端在启动时加载一次，之后每个请求直接复用
+    use_llm 时启动阶段先给模型发一个很短的请求，让 Ollama 把模型加载好；
+    这一步失败（比如 Ollama 还没起来）只记一条警告，服务照常启动，第一条审核再加载模型
+    """
+    def __init__(self, db_path: str = "./demodb.db", use_llm: bool = True, deterministic: bool = True,
+                 triage: triagede1.TriagePolicy = triagede1.DEFAULT_POLICY, parser: str = "ast") -> None:
+        self.store = ragde1.get_rule_store(db_path)
+        self.store.warm_up()
+        # reviewer: 常驻的审核器（模型客户端 + 预编译的审核链），不需要 AI 审核时为 None
+        self.reviewer = aide1.Reviewer(deterministic=deterministic) if use_llm else None
+        if self.reviewer is not None:
+            try:
+                self.reviewer.warm_up()
+            except Exception as e:
+                logde1.log(logger, logging.WARNING, "llm_warm_up_failed", model=self.reviewer.model_name, error=e)
+        # llm_cache: 确定性模式下的回答缓存，同样的代码不会再调用模型
+        self.llm_cache = cachede1.LLMResponseCache() if use_llm and deterministic else None
+        # triage: 分诊策略，None 表示请求了 AI 审核就一定调用模型
+        self.triage = triage
+        # documents: parser="tree_sitter" 时按文件名保存语法树，同一文件再次提交时增量分析，
+        # 有语法错误的代码也能给出部分结果
+        self.documents = None
+        if parser == "tree_sitter":
+            import tsde1
+            self.documents = tsde1.DocumentCache()
+
+    def review(self, job: dict) -> dict:
+        """
+        处理一个审查任务
+        job: {"code": 代码, "filename": 文件名(可选), "llm": 是否调用 AI 审核(可选，默认 False),
+              "force": 跳过分诊、一定调用模型(可选，默认 False)}
+        用 tree-sitter 解析时结果里的 syntax_errors 给出语法错误所在的行，没有错误时为空列表
+        """
+        perfde1.incr("server.requests")
+        start = time.perf_counter()
+        code = job["code"]
+        syntax_errors = None
+        if self.documents is not None:
+            calls, syntax_errors = self.documents.analyze(job.get("filename") or "", code)
+        else:
+            calls = astde1.extract_calls(code)
+        violations = self.store.check(calls)
+        report = aide1.format_report(violations)
+        review = None
+        decision = None
+        if job.get("llm") and self.triage is not None and not job.get("force"):
+            decision = triagede1.triage(code, violations, calls, self.triage)
+        if job.get("llm") and self.reviewer is not None and (decision is None or decision["needed"]):
+            if self.llm_cache is not None:
+                review = aide1.cached_ai_code_review(code, violations, self.reviewer, self.llm_cache)
+            else:
+                review = self.reviewer.review_file(code, violations)
+        return {
+            "filename": job.get("filename"),
+            "report": report,
+            "violations": violations,
+            "review": review,
+            "triage": decision,
+            "syntax_errors": syntax_errors,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+
+    def health(self) -> dict:
+        return {"ok": self.store.health_check(), "rules": len(self.store.rule_index),
+                "llm": self.reviewer is not None}
+
+
+class ReviewHandler(BaseHTTPRequestHandler):
+    """
+    POST /review  提交审查任务，返回 JSON 报告
+    GET  /health  健康检查
+    GET  /metrics 各阶段耗时和计数，Prometheus 文本格式；/metrics?format=json 返回 JSON
+    """
+    service = None  # service: 由 make_server 绑定的 ReviewService
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, self.service.health())
+        elif self.path == "/metrics":
+            self._send_text(200, perfde1.METRICS.to_prometheus(), "text/plain; version=0.0.4")
+        elif self.path == "/metrics?format=json":
+            self._send(200, perfde1.METRICS.snapshot())
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/review":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(job, dict) or not isinstance(job.get("code"), str):
+                raise ValueError("请求体必须是包含 code 字段的 JSON 对象")
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+            return
+        try:
+            result = self.service.review(job)
+        except SyntaxError as e:
+            self._send(422, {"error": f"代码无法解析: {e}"})
+            return
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+            return
+        self._send(200, result)
+
+    def _send(self, status: int, payload: dict) -> None:
+        self._send_text(status, json.dumps(payload, ensure_ascii=False), "application/json")
+
+    def _send_text(self, status: int, text: str, content_type: str) -> None:
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix socket 的 client_address 是空字符串
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service: ReviewService, host: str = "127.0.0.1", port: int = 8765, unix_socket: str = None):
+    """
+    创建 HTTP 服务；指定 unix_socket 时改为监听 Unix socket
+    """
+    handler = type("BoundReviewHandler", (ReviewHandler,), {"service": service})
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="常驻代码审查服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", dest="unix_socket", help="监听 Unix socket 而不是 TCP 端口")
+    parser.add_argument("--db", default="./demodb.db", help="规则库路径")
+    parser.add_argument("--no-llm", action="store_true", help="不加载 LLM，只做规则匹配")
+    parser.add_argument("--sampling", action="store_true", help="关闭确定性模式和回答缓存，按原来的 temperature 采样")
+    parser.add_argument("--no-triage", action="store_true", help="关闭分诊，请求了 AI 审核就一定调用 LLM")
+    parser.add_argument("--parser", choices=astde1.BACKENDS, default="ast",
+                        help="调用点抽取用的解析器，tree_sitter 支持增量分析和有语法错误的代码")
+    logde1.add_arguments(parser)
+    args = parser.parse_args()
+    # 常驻服务不缓冲日志，否则要攒满才会写出
+    logde1.configure_from_args(args, buffer=0)
+
+    print("🚀 正在预热规则库、嵌入模型和 LLM 客户端...")
+    service = ReviewService(args.db, use_llm=not args.no_llm, deterministic=not args.sampling,
+                            triage=None if args.no_triage else triagede1.DEFAULT_POLICY, parser=args.parser)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print(f"✅ 审查服务已启动: {args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("over")
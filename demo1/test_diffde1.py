@@ -0,0 +1,85 @@
+import subprocess
+
+import diffde1
+
+
+def test_hunk_lines_that_look_like_headers():
+    # 删除的行内容以 "-- " 开头、新增的行内容以 "++ " 开头，diff 里就是 "--- " / "+++ "
+    diff_text = "\n".join([
+        "diff --git a/x.py b/x.py",
+        "--- a/x.py",
+        "+++ b/x.py",
+        "@@ -8,4 +8,4 @@ def f():",
+        " a = 1",
+        " b = 2",
+        "--- removed line starting with --",
+        "+++ added line starting with ++",
+        " c = 3",
+        "",
+    ])
+    assert diffde1.parse_unified_diff(diff_text) == {"x.py": [10]}
+
+
+def test_multiple_files_and_deletions():
+    diff_text = "\n".join([
+        "--- a/old.py",
+        "+++ /dev/null",
+        "@@ -1,2 +0,0 @@",
+        "-x = 1",
+        "-y = 2",
+        "--- a/y.py",
+        "+++ b/y.py",
+        "@@ -3,2 +3,0 @@",
+        "-gone()",
+        "-gone()",
+        "@@ -10 +8,2 @@",
+        "-z = 0",
+        "+z = 1",
+        "+w = 2",
+        "\\ No newline at end of file",
+        "",
+    ])
+    assert diffde1.parse_unified_diff(diff_text) == {"y.py": [3, 8, 9]}
+
+
+class _NoRules:
+    def check(self, calls):
+        return []
+
+
+def test_broken_file_reported_per_file(tmp_path):
+    (tmp_path / "good.py").write_text("def f():\n    for i in x:\n        g()\n", encoding="utf-8")
+    (tmp_path / "bad.py").write_text("def f(:\n    pass\n", encoding="utf-8")
+    diff_text = "\n".join([
+        "--- a/good.py",
+        "+++ b/good.py",
+        "@@ -3 +3 @@",
+        "-        h()",
+        "+        g()",
+        "--- a/bad.py",
+        "+++ b/bad.py",
+        "@@ -1 +1 @@",
+        "-def f():",
+        "+def f(:",
+        "",
+    ])
+    results = diffde1.review_unified_diff(diff_text, str(tmp_path), store=_NoRules())
+    assert results["good.py"]["error"] is None
+    assert results["good.py"]["scopes"] == [(1, 3, "f")]
+    assert results["bad.py"]["error"].startswith("SyntaxError")
+
+
+def test_revisions_ignore_prefix_config(tmp_path):
+    def git(*args):
+        subprocess.run(["git", *args], cwd=tmp_path, check=True, capture_output=True)
+    git("init", "-q")
+    git("config", "user.email", "test@example.com")
+    git("config", "user.name", "test")
+    git("config", "diff.mnemonicPrefix", "true")
+    (tmp_path / "m.py").write_text("def f():\n    a()\n", encoding="utf-8")
+    git("add", "m.py")
+    git("commit", "-q", "-m", "base")
+    (tmp_path / "m.py").write_text("def f():\n    b()\n", encoding="utf-8")
+    results = diffde1.review_revisions("HEAD", root=str(tmp_path), store=_NoRules())
+    assert list(results) == ["m.py"]
+    assert results["m.py"]["scopes"] == [(1, 2, "f")]
@@ -0,0 +1,72 @@
+import astde1
+import tsde1
+
+CODE = '''
+import os
+
+@app.route("/x")
+@cache(size())
+def handler(a=default()):
+    if a:
+        print("中文", a)
+    elif b():
+        log.info("x")
+    elif c:
+        x()
+    else:
+        y()
+    for i in get():
+        db.conn.connect()
+    else:
+        done()
+    while q():
+        pass
+
+class K(Base(1)):
+    @staticmethod
+    def m():
+        async def inner():
+            async for z in it():
+                await fetch(z)
+                if z:
+                    save(z)
+        return inner
+
+result = [g(i) for i in r() if h(i)]
+'''
+
+
+def _key(calls) -> list:
+    # 两个后端遍历顺序不同（ast 先访问装饰器和默认参数），按内容排序后再比较
+    return sorted([(site.name, site.action, site.lineno, site.col_offset, site.end_lineno, site.end_col_offset,
+                    site.context, site.function, site.code) for site in calls], key=repr)
+
+
+def test_tree_sitter_backend_matches_ast():
+    expected = _key(astde1.extract_calls(CODE))
+    assert _key(astde1.extract_calls(CODE, backend="tree_sitter")) == expected
+    contexts = {site.action: site.context for site in astde1.extract_calls(CODE)}
+    # elif / else 分支、async for 和装饰器里的调用都要覆盖到
+    assert "If" in contexts["info"] and "If" in contexts["y"]
+    assert "AsyncFor" in contexts["fetch"]
+    assert "route" in contexts and "size" in contexts
+
+
+def test_incremental_edit_and_update():
+    document = tsde1.TreeSitterDocument(CODE)
+    assert _key(document.calls()) == _key(astde1.extract_calls(CODE))
+
+    # edit: 把 elif 分支里的 log.info("x") 换成 log.warning("y", z())
+    start = CODE.index('log.info("x")')
+    edited = CODE[:start] + 'log.warning("y", z())' + CODE[start + len('log.info("x")'):]
+    document.edit(start, start + len('log.info("x")'), 'log.warning("y", z())')
+    assert document.code == edited
+    assert _key(document.calls()) == _key(astde1.extract_calls(edited))
+
+    # update: 在类前面插入一个新的循环，再改回原样
+    updated = edited.replace("class K", "for n in range(3):\n    emit(n)\n\nclass K")
+    document.update(updated)
+    assert _key(document.calls()) == _key(astde1.extract_calls(updated))
+    document.update(CODE)
+    assert _key(document.calls()) == _key(astde1.extract_calls(CODE))
+    assert document.errors() == []
@@ -0,0 +1,98 @@
+import astde1
+import perfde1
+import rulede1
+
+# 严重程度从低到高，规则元数据里没写或写了不认识的按 low 算
+SEVERITY_LEVELS = {"low": 1, "medium": 2, "high": 3}
+
+# 危险调用：不管在哪里出现都值得让 AI 看一眼
+RISKY_CALLS = {"eval", "exec", "compile", "__import__", "os.system", "os.popen", "pickle.loads",
+               "pickle.load", "marshal.loads", "yaml.load", "subprocess.call", "subprocess.run",
+               "subprocess.Popen", "subprocess.check_output"}
+
+# 放在循环里很可能是性能问题的 I/O 动作：这些动作名本身就是数据库 / 网络 / 文件读取，不管调用对象是谁
+LOOP_IO_ACTIONS = {"connect", "execute", "executemany", "commit", "fetchall", "urlopen", "read_csv"}
+
+# get / post 这类通用动作名只在调用对象是 HTTP 客户端时才算 I/O（dict.get、queue.put 不算）：
+# 调用对象的最后一段（requests.get 的 requests、self.session.get 的 session）在 LOOP_IO_RECEIVERS 里
+LOOP_IO_VERBS = {"get", "post", "put", "patch", "delete", "head", "request"}
+LOOP_IO_RECEIVERS = {"requests", "httpx", "session", "client", "http"}
+
+
+class TriagePolicy:
+    """
+    决定一个文件要不要交给 LLM 复核的条件，满足任意一条就调用模型：
+    - 严重程度达到 min_severity 的违规至少有 min_violations 处（低于 min_severity 的违规不计数）
+    - heuristics=True 时，AST 里有危险调用、循环里的 I/O、max_loop_depth 层以上的嵌套循环，
+      或者吞掉异常的裸 except
+    什么都没命中的文件直接用 RAG 报告，不再花一次模型调用
+    """
+    def __init__(self, min_severity: str = "high", min_violations: int = 1, heuristics: bool = True,
+                 max_loop_depth: int = 3) -> None:
+        self.min_severity = min_severity
+        self.min_violations = min_violations
+        self.heuristics = heuristics
+        self.max_loop_depth = max_loop_depth
+
+
+# 默认策略
+DEFAULT_POLICY = TriagePolicy()
+
+
+def severity_level(severity: str) -> int:
+    return SEVERITY_LEVELS.get(str(severity).lower(), 1)
+
+
+# 启发式检查里用到的 AST 规则，和其他规则共用一次遍历
+_HEURISTIC_RULES = rulede1.RuleEngine([rulede1.SwallowedExceptionRule()])
+
+
+def _is_loop_io(site: astde1.CallSite) -> bool:
+    if site.action in LOOP_IO_ACTIONS:
+        return True
+    if site.action not in LOOP_IO_VERBS or not site.name:
+        return False
+    receiver = site.name.rpartition(".")[0]
+    return receiver.rpartition(".")[2] in LOOP_IO_RECEIVERS
+
+
+def _swallowed_exceptions(code: str) -> int:
+    """
+    统计裸 except 和只有 pass 的 except Exception
+    """
+    return len(_HEURISTIC_RULES.run(code)["findings"])
+
+
+@perfde1.timed("review.triage")
+def triage(code: str, violations: list, calls: astde1.CallIndex = None, policy: TriagePolicy = None) -> dict:
+    """
+    分诊：判断这份代码是否需要 LLM 复核
+    calls: 已经抽取好的调用点，不传时重新抽取
+    返回 {"needed": 是否需要调用模型, "reasons": 需要的原因列表}
+    """
+    if policy is None:
+        policy = DEFAULT_POLICY
+    reasons = []
+    threshold = severity_level(policy.min_severity)
+    severe = [v for v in violations if severity_level(v.get("severity")) >= threshold]
+    if severe and len(severe) >= policy.min_violations:
+        reasons.append(f"{len(severe)} 处 {policy.min_severity} 及以上级别的违规")
+    if policy.heuristics:
+        if calls is None:
+            calls = astde1.extract_calls(code)
+        risky = sorted({site.name for site in calls if site.name in RISKY_CALLS})
+        if risky:
+            reasons.append(f"危险调用: {', '.join(risky)}")
+        loop_io = sorted({site.name or site.action for site in calls.under("loop") if _is_loop_io(site)})
+        if loop_io:
+            reasons.append(f"循环里的 I/O: {', '.join(loop_io)}")
+        if any(site.loop_depth >= policy.max_loop_depth for site in calls):
+            reasons.append(f"{policy.max_loop_depth} 层以上的嵌套循环")
+        try:
+            swallowed = _swallowed_exceptions(code)
+        except SyntaxError:
+            # 有语法错误的代码（tree-sitter 解析的部分结果）跳过这一项
+            swallowed = 0
+        if swallowed:
+            reasons.append(f"{swallowed} 处吞掉异常的 except")
+    return {"needed": bool(reasons), "reasons": reasons}
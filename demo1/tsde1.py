@@ -0,0 +1,281 @@
+import threading
+from collections import OrderedDict
+
+import astde1
+import grammarde1
+import perfde1
+
+# 会改变调用环境的控制结构：节点类型 -> 环境名，和 astde1 的 For / While / AsyncFor / If 对应
+_LOOP_NODES = {"for_statement": "For", "while_statement": "While"}
+_FUNCTION_NODES = ("function_definition",)
+
+
+def _parse(source: bytes, old_tree=None):
+    """
+    用当前线程的 Parser 解析（见 grammarde1.parser），多线程同时解析不用排队
+    """
+    with perfde1.stage("tree_sitter.parse"):
+        parser = grammarde1.parser()
+        if old_tree is None:
+            return parser.parse(source)
+        return parser.parse(source, old_tree=old_tree)
+
+
+class _Span:
+    """
+    调用点位置，字段和 ast 节点一样（行号从 1 开始，列是 UTF-8 字节偏移），CallSite 可以直接用
+    """
+    __slots__ = ("lineno", "col_offset", "end_lineno", "end_col_offset")
+
+    def __init__(self, lineno: int, col_offset: int, end_lineno: int, end_col_offset: int) -> None:
+        self.lineno = lineno
+        self.col_offset = col_offset
+        self.end_lineno = end_lineno
+        self.end_col_offset = end_col_offset
+
+
+def _call_name(node) -> tuple:
+    """
+    和 astde1.call_name 一样返回 (点分名称, 动作名)
+    """
+    func = node.child_by_field_name("function")
+    parts = []
+    while func is not None and func.type == "attribute":
+        parts.append(func.child_by_field_name("attribute").text.decode("utf8"))
+        func = func.child_by_field_name("object")
+    if func is not None and func.type == "identifier":
+        parts.append(func.text.decode("utf8"))
+        name = ".".join(reversed(parts))
+        return name, name.rpartition(".")[2]
+    if parts:
+        return None, parts[0]
+    return None, "unknown"
+
+
+def _definition_name(node) -> str:
+    name = node.child_by_field_name("name")
+    return name.text.decode("utf8") if name is not None else ""
+
+
+def _statement_calls(root) -> list:
+    """
+    抽取一个顶层语句里的调用点，位置记成相对语句起点的偏移，语句整体挪动后还能复用：
+    [(点分名称, 动作名, 相对行, 列, 相对结束行, 结束列, 环境栈, 所在函数)]
+    （相对行为 0 的列是相对语句起始列的偏移，其余行是绝对列）
+    环境判断和 astde1.extract_calls 一致：elif 按 ast 的嵌套 If 计层数，else 跟在最后一个 elif 后面
+    """
+    base_row, base_col = root.start_point
+    records = []
+    # stack: 待访问的 (节点, 环境栈, 所在函数, 限定名前缀)
+    stack = [(root, (), None, "")]
+    while stack:
+        node, context, function, prefix = stack.pop()
+        node_type = node.type
+        if node_type == "call":
+            name, action = _call_name(node)
+            (row, col), (end_row, end_col) = node.start_point, node.end_point
+            records.append((name, action, row - base_row, col - base_col if row == base_row else col,
+                            end_row - base_row, end_col - base_col if end_row == base_row else end_col,
+                            context, function))
+        children = node.children
+        kind = _LOOP_NODES.get(node_type)
+        if kind is not None:
+            if kind == "For" and children and children[0].type == "async":
+                kind = "AsyncFor"
+            context = context + (kind,)
+        elif node_type == "if_statement":
+            context = context + ("If",)
+            elifs = 0
+            child_contexts = []
+            for child in children:
+                if child.type == "elif_clause":
+                    elifs += 1
+                    child_contexts.append(context + ("If",) * elifs)
+                elif child.type == "else_clause":
+                    child_contexts.append(context + ("If",) * elifs)
+                else:
+                    child_contexts.append(context)
+            for child, child_context in zip(reversed(children), reversed(child_contexts)):
+                stack.append((child, child_context, function, prefix))
+            continue
+        elif node_type == "decorated_definition":
+            # 装饰器在 ast 里属于被装饰的函数，先把函数名定下来
+            definition = node.child_by_field_name("definition")
+            if definition is not None and definition.type in _FUNCTION_NODES:
+                function = prefix + _definition_name(definition)
+        elif node_type in _FUNCTION_NODES:
+            function = prefix + _definition_name(node)
+            prefix = function + "."
+        elif node_type == "class_definition":
+            prefix = prefix + _definition_name(node) + "."
+        for child in reversed(children):
+            stack.append((child, context, function, prefix))
+    return records
+
+
+def _error_lines(root) -> list:
+    """
+    语法错误的位置 [(起始行, 结束行)]，只往 has_error 的子树里找
+    """
+    errors = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.is_error or node.is_missing:
+            errors.append((node.start_point[0] + 1, node.end_point[0] + 1))
+            continue
+        stack.extend(child for child in reversed(node.children) if child.has_error or child.is_missing)
+    return errors
+
+
+def _common_prefix(a: str, b: str) -> int:
+    """
+    两个字符串公共前缀的长度（二分 + 切片比较，比较在 C 里做）
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _point(text: str) -> tuple:
+    """
+    text 末尾在 tree-sitter 坐标里的位置：(行, 该行的 UTF-8 字节列)
+    用普通元组，不构造 tree_sitter.Point（0.26 版手动构造的 Point 在垃圾回收时会让进程崩溃）
+    """
+    return text.count("\n"), len(text[text.rfind("\n") + 1:].encode("utf-8"))
+
+
+class TreeSitterDocument:
+    """
+    一份正在编辑的源码（编辑器、watch 模式用）
+    - 每次修改只告诉 tree-sitter 改了哪一段，再把旧语法树传给 parser 做增量解析
+    - 调用点按顶层语句缓存，内容没变的语句直接复用上次的结果，只重新抽取改动过的语句（有语法错误时不走缓存）
+    - 代码有语法错误时照样能分析，出错的部分由 errors() 给出，其余调用点正常抽取
+    """
+    def __init__(self, code: str) -> None:
+        self.code = code
+        self.tree = _parse(code.encode("utf-8"))
+        self._statements = {}  # _statements: (节点类型, 顶层语句源码) -> 相对位置的调用点记录
+        self._calls = None
+
+    def edit(self, start: int, end: int, text: str) -> None:
+        """
+        把 code[start:end]（字符下标）替换成 text，增量重新解析
+        """
+        old, new = self.code, self.code[:start] + text + self.code[end:]
+        start_byte = len(old[:start].encode("utf-8"))
+        self.tree.edit(
+            start_byte=start_byte,
+            old_end_byte=start_byte + len(old[start:end].encode("utf-8")),
+            new_end_byte=start_byte + len(text.encode("utf-8")),
+            start_point=_point(old[:start]),
+            old_end_point=_point(old[:end]),
+            new_end_point=_point(new[:start + len(text)]),
+        )
+        self.code = new
+        self.tree = _parse(new.encode("utf-8"), self.tree)
+        self._calls = None
+
+    def update(self, code: str) -> None:
+        """
+        只拿到修改后的完整源码时（比如文件保存），找出改动的那一段再交给 edit
+        """
+        if code == self.code:
+            return
+        start = _common_prefix(self.code, code)
+        # 公共后缀不能和公共前缀重叠
+        limit = min(len(self.code), len(code)) - start
+        suffix = min(_common_prefix(self.code[::-1], code[::-1]), limit)
+        self.edit(start, len(self.code) - suffix, code[start:len(code) - suffix])
+
+    @property
+    def has_error(self) -> bool:
+        return self.tree.root_node.has_error
+
+    def errors(self) -> list:
+        return _error_lines(self.tree.root_node) if self.has_error else []
+
+    @perfde1.timed("tree_sitter.extract_calls")
+    def calls(self) -> astde1.CallIndex:
+        """
+        和 astde1.extract_calls 格式相同的调用点索引
+        """
+        if self._calls is not None:
+            return self._calls
+        source = astde1._SourceText(self.code)
+        source_bytes = source.code.encode("utf-8")
+        index = astde1.CallIndex()
+        statements = {}
+        # 有语法错误时，同样的源码经过错误恢复可能解析成不同的树，取决于周围的代码，整棵树都不用缓存
+        cacheable = not self.tree.root_node.has_error
+        for statement in self.tree.root_node.children:
+            key = (statement.type, source_bytes[statement.start_byte:statement.end_byte])
+            records = self._statements.get(key) if cacheable else None
+            if records is None:
+                records = _statement_calls(statement)
+                perfde1.incr("tree_sitter.statements_analyzed")
+            if cacheable:
+                statements[key] = records
+            base_row, base_col = statement.start_point
+            for name, action, row, col, end_row, end_col, context, function in records:
+                span = _Span(base_row + row + 1, col + base_col if row == 0 else col,
+                             base_row + end_row + 1, end_col + base_col if end_row == 0 else end_col)
+                index.add(astde1.CallSite(name, action, span, context, function, source))
+        # 只保留当前版本用到的语句，缓存大小和文件大小成正比；有语法错误的版本保留上一次无错的缓存
+        if cacheable:
+            self._statements = statements
+        self._calls = index
+        return index
+
+
+def extract_calls(code: str) -> astde1.CallIndex:
+    """
+    用 tree-sitter 抽取调用点，语法错误不抛异常，能解析的部分照常返回
+    """
+    return TreeSitterDocument(code).calls()
+
+
+class _CachedDocument:
+    """
+    DocumentCache 里的一项：文档和它自己的锁，同一个文件的分析排队，不同文件互不等待
+    """
+    __slots__ = ("lock", "document")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.document = None
+
+
+class DocumentCache:
+    """
+    按文件名保存 TreeSitterDocument，同一个文件再次提交时做增量分析
+    最多保存 max_documents 个文件，超出时丢掉最久没用的；线程安全
+    - 整个缓存的锁只在查找、插入和淘汰时持有
+    - 解析和提取在各文档自己的锁里做，不同文件可以同时分析
+    """
+    def __init__(self, max_documents: int = 256) -> None:
+        self.max_documents = max_documents
+        self._documents = OrderedDict()  # _documents: 文件名 -> _CachedDocument
+        self._lock = threading.Lock()
+
+    def analyze(self, name: str, code: str) -> tuple:
+        """
+        返回 (调用点索引, 语法错误位置列表)
+        """
+        with self._lock:
+            entry = self._documents.pop(name, None) or _CachedDocument()
+            self._documents[name] = entry
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        # 刚被淘汰的文档仍然可以在这里分析完，只是不会再被复用
+        with entry.lock:
+            if entry.document is None:
+                entry.document = TreeSitterDocument(code)
+            else:
+                entry.document.update(code)
+            return entry.document.calls(), entry.document.errors()
@@ -0,0 +1,150 @@
+import json
+
+from tree_sitter import Query
+
+import grammarde1
+import perfde1
+import rulede1
+import tsde1
+
+try:
+    # 0.25 起查询由 QueryCursor 执行
+    from tree_sitter import QueryCursor
+except ImportError:
+    QueryCursor = None
+
+# 调用规则编译成的查询：函数名（或属性调用的最后一段）是规则里的动作之一
+_CALL_QUERY = """
+((call function: [(identifier) @action
+                  (attribute attribute: (identifier) @action)]) @call
+ (#any-of? @action {actions}))
+"""
+
+# 会改变调用环境的控制结构，elif / else 分支都在 if_statement 的范围里
+_SCOPE_QUERY = """
+(for_statement) @for
+(while_statement) @while
+(if_statement) @if
+"""
+
+_FOR, _WHILE, _ASYNC_FOR, _IF = (rulede1.CONTEXT_MASKS[kind] for kind in ("For", "While", "AsyncFor", "If"))
+
+
+def _query(source: str) -> Query:
+    language = grammarde1.language()
+    if QueryCursor is None:
+        return language.query(source)
+    return Query(language, source)
+
+
+def _matches(query: Query, node) -> list:
+    """
+    各版本 py-tree-sitter 的 matches 统一成 [(模式下标, {捕获名: [节点]})]
+    """
+    matches = QueryCursor(query).matches(node) if QueryCursor is not None else query.matches(node)
+    return [(pattern, {name: nodes if isinstance(nodes, list) else [nodes] for name, nodes in captures.items()})
+            for pattern, captures in matches]
+
+
+def _captures(query: Query, node) -> dict:
+    """
+    各版本 py-tree-sitter 的 captures 统一成 {捕获名: [节点]}
+    （0.23 以前返回 [(节点, 捕获名)]）
+    """
+    captures = QueryCursor(query).captures(node) if QueryCursor is not None else query.captures(node)
+    if isinstance(captures, dict):
+        return captures
+    grouped = {}
+    for captured, name in captures:
+        grouped.setdefault(name, []).append(captured)
+    return grouped
+
+
+def _scope_ranges(query: Query, root) -> list:
+    """
+    所有循环和 if 的字节范围 [(起点, 终点, 标志位)]，按起点排序
+    """
+    ranges = []
+    for name, nodes in _captures(query, root).items():
+        for node in nodes:
+            if name == "for":
+                bit = _ASYNC_FOR if node.child(0).type == "async" else _FOR
+            else:
+                bit = _WHILE if name == "while" else _IF
+            ranges.append((node.start_byte, node.end_byte, bit))
+    ranges.sort()
+    return ranges
+
+
+def _context_flags(starts: list, scopes: list) -> list:
+    """
+    区间查找：每个调用点（按起点排好序）外层有哪些控制结构
+    语法树的区间要么嵌套要么不相交，扫描时用栈记住还没结束的区间和它们的标志位之和
+    """
+    flags = []
+    stack = []  # stack: (区间终点, 到这一层为止的标志位)
+    i = 0
+    for start in starts:
+        while i < len(scopes) and scopes[i][0] <= start:
+            scope_start, scope_end, bit = scopes[i]
+            while stack and stack[-1][0] <= scope_start:
+                stack.pop()
+            stack.append((scope_end, (stack[-1][1] if stack else 0) | bit))
+            i += 1
+        while stack and stack[-1][0] <= start:
+            stack.pop()
+        flags.append(stack[-1][1] if stack else 0)
+    return flags
+
+
+class QueryRuleSet:
+    """
+    把调用规则（rulede1.CallInContextRule，比如 rulede1.rules_from_index 的结果）编译成 tree-sitter 查询
+    - 所有规则的动作名合成一个带 #any-of? 的查询，由 tree-sitter 在 C 里匹配，只有命中的调用点才回到 Python
+    - 循环 / if 的范围用另一个查询取出，再按字节区间判断调用点在哪些结构里
+    - 命中后按 (动作名, 环境标志位) 查表找规则，和 RuleEngine 的判断一致
+    """
+    def __init__(self, rules: list) -> None:
+        self.rules = list(rules)
+        self._by_action = {}  # _by_action: (动作名, 标志位) -> 规则列表
+        for rule in self.rules:
+            for action in rule.actions:
+                for flags in range(rulede1._FLAG_COMBINATIONS):
+                    if rule.accepts(flags):
+                        self._by_action.setdefault((action, flags), []).append(rule)
+        actions = sorted({action for rule in self.rules for action in rule.actions})
+        # source: 编译出来的查询文本，方便排查
+        self.source = _CALL_QUERY.format(actions=" ".join(json.dumps(action, ensure_ascii=False) for action in actions))
+        self._call_query = _query(self.source) if actions else None
+        self._scope_query = _query(_SCOPE_QUERY)
+
+    @perfde1.timed("tree_sitter.query")
+    def check(self, code: str, tree=None) -> list:
+        """
+        返回和 rag_check 格式相同的违规列表（另带 id 和 lineno），按调用点在源码里的顺序排列
+        tree: 已经解析好的语法树（比如 TreeSitterDocument.tree），不传时现场解析
+        """
+        if self._call_query is None:
+            return []
+        if tree is None:
+            tree = tsde1._parse(code.encode("utf-8"))
+        root = tree.root_node
+        hits = []  # hits: (调用节点, 动作名)
+        for _, captures in _matches(self._call_query, root):
+            hits.append((captures["call"][0], captures["action"][0].text.decode("utf8")))
+        if not hits:
+            return []
+        hits.sort(key=lambda hit: hit[0].start_byte)
+        flags = _context_flags([call.start_byte for call, _ in hits], _scope_ranges(self._scope_query, root))
+        violations = []
+        for (call, action), call_flags in zip(hits, flags):
+            for rule in self._by_action.get((action, call_flags), ()):
+                violations.append({
+                    "id": rule.id,
+                    "code": call.text.decode("utf8"),
+                    "rule": rule.message,
+                    "severity": rule.severity,
+                    "context": rule.matched_context(call_flags),
+                    "lineno": call.start_point[0] + 1,
+                })
+        return violations
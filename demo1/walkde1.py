@@ -0,0 +1,87 @@
+import ast
+
+
+class Visitor:
+    """
+    非递归的遍历器基类，同时支持 Python ast 和 tree-sitter 的语法树
+    子类按节点类型写处理方法：
+    - enter_<类型>(node)（也可以写成 visit_<类型>）：进入节点时调用，返回 False 时跳过它的子节点
+    - leave_<类型>(node)：离开节点时调用（子节点都处理完之后；跳过子节点时也会调用）
+    - generic_enter / generic_leave：没有对应类型的处理方法时调用
+    类型名对 ast 是类名（如 For、Call），对 tree-sitter 是 node.type（如 for_statement、call）
+    遍历用显式的栈（tree-sitter 用 TreeCursor），嵌套多深都不会 RecursionError；
+    每种节点类型的处理方法只在第一次遇到时按名字查找一次，之后直接查缓存
+    """
+
+    @classmethod
+    def _handlers(cls, key, name: str) -> tuple:
+        """
+        节点类型 -> (enter, leave)，每个子类各自缓存，没有处理方法时为 None
+        """
+        cache = cls.__dict__.get("_handler_cache")
+        if cache is None:
+            cache = {}
+            cls._handler_cache = cache
+        handlers = cache.get(key)
+        if handlers is None:
+            enter = getattr(cls, f"enter_{name}", None) or getattr(cls, f"visit_{name}", None) \
+                or getattr(cls, "generic_enter", None)
+            leave = getattr(cls, f"leave_{name}", None) or getattr(cls, "generic_leave", None)
+            handlers = cache[key] = (enter, leave)
+        return handlers
+
+    def visit(self, node) -> None:
+        """
+        遍历 node 为根的整棵子树：ast 节点走 walk_ast，其余当作 tree-sitter 节点或语法树
+        """
+        if isinstance(node, ast.AST):
+            walk_ast(self, node)
+        else:
+            walk_tree_sitter(self, node)
+
+
+def walk_ast(visitor: Visitor, root: ast.AST) -> None:
+    """
+    前序遍历 ast，顺序和 ast.NodeVisitor 相同
+    """
+    handlers = type(visitor)._handlers
+    # stack: 待处理的 (节点, 是否是离开事件)
+    stack = [(root, False)]
+    while stack:
+        node, leaving = stack.pop()
+        node_type = type(node)
+        enter, leave = handlers(node_type, node_type.__name__)
+        if leaving:
+            leave(visitor, node)
+            continue
+        descend = enter is None or enter(visitor, node) is not False
+        if leave is not None:
+            stack.append((node, True))
+        if descend:
+            children = list(ast.iter_child_nodes(node))
+            for child in reversed(children):
+                stack.append((child, False))
+
+
+def walk_tree_sitter(visitor: Visitor, root) -> None:
+    """
+    用 TreeCursor 前序遍历 tree-sitter 语法树，不为每一层创建子节点列表
+    root 可以是 Tree 或 Node；只遍历 root 这棵子树
+    """
+    handlers = type(visitor)._handlers
+    cursor = root.walk()
+    while True:
+        node = cursor.node
+        enter, _ = handlers(node.kind_id, node.type)
+        if (enter is None or enter(visitor, node) is not False) and cursor.goto_first_child():
+            continue
+        # 叶子节点（或跳过了子节点）：离开它，再往上找下一个兄弟节点
+        while True:
+            node = cursor.node
+            leave = handlers(node.kind_id, node.type)[1]
+            if leave is not None:
+                leave(visitor, node)
+            if cursor.goto_next_sibling():
+                break
+            if not cursor.goto_parent():
+                return
@@ -3,8 +3,11 @@ from langchain_ollama import ChatOllama
 from langchain.agents import create_agent
 import chromadb
 from chromadb.utils import embedding_functions
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo1"))
+from cachede1 import cached_default_ef
 clint = chromadb.Client()
-default_ef = embedding_functions.DefaultEmbeddingFunction()
+default_ef = cached_default_ef()
 collection=clint.get_or_create_collection(
     name="my_rag",
     embedding_function=default_ef
@@ -1,23 +1,13 @@
-import chromadb
+import os, sys
 import libcst as cst
-from chromadb.utils import embedding_functions
-from langchain_ollama import ChatOllama
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+# chromadb / langchain 只有演示用得到，放在 __main__ 里导入，
+# 这样 benchde1 等模块导入 fenxi 时不需要装这些依赖
 
-llm=ChatOllama(
-    model="qwen3:1.7b",
-    temperature=0
-)
-def ai(user_code,rules_text):
-    ai_response=chain.invoke
+def ai(prompt, llm):
+    from langchain_core.output_parsers import StrOutputParser
+    chain = llm | StrOutputParser()
+    return chain.invoke(prompt)
 
-client = chromadb.Client()
-default_ef=embedding_functions.DefaultEmbeddingFunction()
-collection =client.get_or_create_collection(
-    name="test",
-    embedding_function=default_ef
-)
 rules_data = [
     {
         "id": "R1", 
@@ -38,18 +28,14 @@ rules_data = [
         "tags": ["loop", "naming"]
     }
 ]
-docs_to_store = [f"{r['desc']} Keywords: {r['keywords']}" for r in rules_data]
-collection.add(
-    documents=docs_to_store,
-    ids=[r["id"] for r in rules_data],
-    metadatas=[{"tags": r["tags"]} for r in rules_data] # 关键：用标签分类
-)
 class fenxi(cst.CSTVisitor):
     def __init__(self):
         self.is_loop=False
-        self.action=[]
+        self.has_loop=False # 代码里是否出现过循环（离开循环后 is_loop 会复位）
+        self.actions=[]
     def visit_For(self, node):
         self.is_loop = True
+        self.has_loop = True
         # 继续遍历循环体内部
         return True 
 
@@ -69,7 +55,30 @@ class fenxi(cst.CSTVisitor):
             
         if func_name:
             self.actions.append(func_name)
-user_code = """
+if __name__ == "__main__":
+    import chromadb
+    from langchain_ollama import ChatOllama
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo1"))
+    from cachede1 import cached_default_ef
+
+    llm=ChatOllama(
+        model="qwen3:1.7b",
+        temperature=0
+    )
+
+    client = chromadb.Client()
+    default_ef=cached_default_ef()
+    collection =client.get_or_create_collection(
+        name="test",
+        embedding_function=default_ef
+    )
+    docs_to_store = [f"{r['desc']} Keywords: {r['keywords']}" for r in rules_data]
+    collection.add(
+        documents=docs_to_store,
+        ids=[r["id"] for r in rules_data],
+        metadatas=[{"tags": r["tags"]} for r in rules_data] # 关键：用标签分类
+    )
+    user_code = """
 for i in range(10):
     # 错误 1: 在循环里连库 (触发 R1)
     db.connect() 
@@ -81,51 +90,52 @@ for i in range(10):
     item = process_data(i)
 """
 
-print(f"\n👀 待审查代码:\n{user_code}")
-wrapper = cst.metadata.MetadataWrapper(cst.parse_module(user_code))
-visitor = fenxi()
-wrapper.visit(visitor)
+    print(f"\n👀 待审查代码:\n{user_code}")
+    wrapper = cst.metadata.MetadataWrapper(cst.parse_module(user_code))
+    visitor = fenxi()
+    wrapper.visit(visitor)
+
+    # 分析结果
+    structure_tags = ["loop"] if visitor.has_loop else []
+    detected_actions = visitor.actions # ["connect", "print", "process_data"]
 
-# 分析结果
-structure_tags = ["loop"] if visitor.is_loop else []
-detected_actions = visitor.actions # ["connect", "print", "process_data"]
+    print(f"🔍 [AST 分析] 结构标签: {structure_tags}, 动作指纹: {detected_actions}")
 
-print(f"🔍 [AST 分析] 结构标签: {structure_tags}, 动作指纹: {detected_actions}")
+    # --- 阶段 B: 精准特征检索 (解决漏查和无数条结果) ---
+    triggered_rules = []
 
-# --- 阶段 B: 精准特征检索 (解决漏查和无数条结果) ---
-triggered_rules = []
+    if "loop" in structure_tags:
+        # 策略：所有动作先去重，再一次性批量检索 (一次嵌入 + 一次多查询)，结果按动作分发回去
+        unique_actions = list(dict.fromkeys(detected_actions))
+        print(f"\n🔄 正在批量检索特征: {unique_actions} ...")
 
-if "loop" in structure_tags:
-    # 策略：针对每一个动作，都去库里查一次 (点对点)
-    for action in detected_actions:
-        print(f"\n🔄 正在检索特征: '{action}' ...")
-        
         results = collection.query(
-            query_texts=[action], # 用动作名 (如 connect) 去匹配 Keywords
+            query_texts=unique_actions, # 用动作名 (如 connect) 去匹配 Keywords
             where={"tags": {"$in": ["loop"]}}, # 限定只在 loop 标签里查
             n_results=1 # 每个动作只取最相关的一条
         )
-        
-        # 检查距离，只有足够近才算命中
-        if results['distances'][0][0] < 0.35:
-            rule_id = results['ids'][0][0]
-            rule_content = results['documents'][0][0]
-            
-            # 去重：防止不同动作触发同一条规则
-            if rule_id not in triggered_rules:
-                triggered_rules.append(rule_id)
-                print(f"✅ 命中规则 [{rule_id}]: {rule_content[:30]}...")
+
+        for action, ids, documents, distances in zip(unique_actions, results['ids'], results['documents'], results['distances']):
+            # 检查距离，只有足够近才算命中
+            if distances and distances[0] < 0.35:
+                rule_id = ids[0]
+                rule_content = documents[0]
+
+                # 去重：防止不同动作触发同一条规则
+                if rule_id not in triggered_rules:
+                    triggered_rules.append(rule_id)
+                    print(f"✅ '{action}' 命中规则 [{rule_id}]: {rule_content[:30]}...")
+                else:
+                    print(f"♻️ 规则 [{rule_id}] 已触发，跳过。")
             else:
-                print(f"♻️ 规则 [{rule_id}] 已触发，跳过。")
-        else:
-            print(f"⚪ 未找到相关规则 (距离: {results['distances'][0][0]:.2f})")
+                print(f"⚪ '{action}' 未找到相关规则 (距离: {distances[0] if distances else float('nan'):.2f})")
 
-# --- 阶段 C: 汇总并生成 Prompt ---
-if triggered_rules:
-    # 根据 ID 拿回完整的规则描述给 AI 看
-    final_rules_data = collection.get(ids=triggered_rules)
+    # --- 阶段 C: 汇总并生成 Prompt ---
+    if triggered_rules:
+        # 根据 ID 拿回完整的规则描述给 AI 看
+        final_rules_data = collection.get(ids=triggered_rules)
     
-    prompt = f"""
+        prompt = f"""
     你是一个资深代码审查专家。请审查以下代码。
     
     用户代码:
@@ -136,8 +146,8 @@ if triggered_rules:
     请指出代码中违反了哪些规则，并给出修改建议。
     """
     
-    # --- 阶段 D: 调用 AI ---
-    ai_response = ai(prompt)
-    print(ai_response)
-else:
-    print("\n✅ 代码审查通过，未发现明显违规。")
\ No newline at end of file
+        # --- 阶段 D: 调用 AI ---
+        ai_response = ai(prompt, llm)
+        print(ai_response)
+    else:
+        print("\n✅ 代码审查通过，未发现明显违规。")
\ No newline at end of file
@@ -10,10 +10,17 @@ print("请确保已安装以下库：")
 print("pip install tree-sitter tree-sitter-python")
 
 # 尝试导入 tree-sitter
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo1"))
+# 非递归遍历器：visit_xxx 方法按节点类型分发，嵌套再深也不会 RecursionError
+import walkde1
+
 print("\n正在导入 Tree-sitter...")
 try:
     import tree_sitter
-    from tree_sitter import Language, Parser
+    # 离线加载语法：优先用 tree-sitter-python 包自带的语法，其次是预编译的语法库，不会现场 git clone 和编译
+    import grammarde1
     print("✅ Tree-sitter 导入成功")
 except ImportError as e:
     print(f"❌ Tree-sitter 导入失败：{e}")
@@ -26,42 +33,14 @@ print("-" * 80)
 
 # 加载 Python 语言解析器
 try:
-    # 查找或编译 Python 语言解析器
-    PYTHON_LANGUAGE = Language('build/my-languages.so', 'python')
+    PYTHON_LANGUAGE = grammarde1.language()
     print("✅ Python 语言解析器加载成功")
-except Exception as e:
-    print(f"⚠️  无法加载预编译的 Python 语言解析器：{e}")
-    print("正在尝试编译 Python 语言解析器...")
-    
-    try:
-        # 从 GitHub 克隆并编译 Python 语言解析器
-        import os
-        import subprocess
-        
-        # 创建 build 目录
-        os.makedirs('build', exist_ok=True)
-        
-        # 克隆 python 语言定义
-        if not os.path.exists('tree-sitter-python'):
-            subprocess.run(['git', 'clone', 'https://github.com/tree-sitter/tree-sitter-python.git'], check=True)
-        
-        # 编译语言解析器
-        Language.build_library(
-            'build/my-languages.so',
-            ['tree-sitter-python']
-        )
-        
-        # 重新加载
-        PYTHON_LANGUAGE = Language('build/my-languages.so', 'python')
-        print("✅ Python 语言解析器编译并加载成功")
-    except Exception as compile_e:
-        print(f"❌ Python 语言解析器编译失败：{compile_e}")
-        print("请手动安装并配置 tree-sitter-python")
-        exit(1)
-
-# 创建解析器
-parser = Parser()
-parser.set_language(PYTHON_LANGUAGE)
+except ImportError as e:
+    print(f"❌ 无法加载 Python 语言解析器：{e}")
+    exit(1)
+
+# 创建解析器（同一线程里反复调用 grammarde1.parser() 拿到的是同一个解析器）
+parser = grammarde1.parser()
 print("✅ Tree-sitter 解析器初始化完成")
 
 # ========================================
@@ -92,11 +71,20 @@ print(f"子节点数量: {len(root_node.children)}")
 # 打印完整的 AST 结构
 print("\n完整的 AST 结构：")
 
-def print_node(node, level=0):
-    indent = "  " * level
-    print(f"{indent}{node.type} [{node.start_point[0]}:{node.start_point[1]} - {node.end_point[0]}:{node.end_point[1]}]")
-    for child in node.children:
-        print_node(child, level + 1)
+class NodePrinter(walkde1.Visitor):
+    def __init__(self):
+        self.level = 0
+    
+    def generic_enter(self, node):
+        indent = "  " * self.level
+        print(f"{indent}{node.type} [{node.start_point[0]}:{node.start_point[1]} - {node.end_point[0]}:{node.end_point[1]}]")
+        self.level += 1
+    
+    def generic_leave(self, node):
+        self.level -= 1
+
+def print_node(node):
+    NodePrinter().visit(node)
 
 print_node(root_node)
 
@@ -125,23 +113,13 @@ tree = parser.parse(bytes(code_visitor, 'utf8'))
 root_node = tree.root_node
 
 # 定义遍历器类
-class TreeSitterVisitor:
+class TreeSitterVisitor(walkde1.Visitor):
     def __init__(self):
         self.function_count = 0
         self.for_loop_count = 0
         self.function_names = []
         self.function_calls = []
     
-    def visit(self, node):
-        # 访问当前节点
-        method_name = f"visit_{node.type}"
-        if hasattr(self, method_name):
-            getattr(self, method_name)(node)
-        
-        # 访问子节点
-        for child in node.children:
-            self.visit(child)
-    
     def visit_function_definition(self, node):
         """访问函数定义节点"""
         self.function_count += 1
@@ -201,18 +179,10 @@ def process_user(user: User, action: str = "default") -> bool:
 print("示例代码：")
 print(code_function)
 
-class FunctionInfoVisitor:
+class FunctionInfoVisitor(walkde1.Visitor):
     def __init__(self):
         self.functions = []
     
-    def visit(self, node):
-        method_name = f"visit_{node.type}"
-        if hasattr(self, method_name):
-            getattr(self, method_name)(node)
-        
-        for child in node.children:
-            self.visit(child)
-    
     def visit_function_definition(self, node):
         func_info = {
             "name": "",
@@ -302,18 +272,10 @@ class Dog(Animal):
 print("示例代码：")
 print(code_class)
 
-class ClassInfoVisitor:
+class ClassInfoVisitor(walkde1.Visitor):
     def __init__(self):
         self.classes = []
     
-    def visit(self, node):
-        method_name = f"visit_{node.type}"
-        if hasattr(self, method_name):
-            getattr(self, method_name)(node)
-        
-        for child in node.children:
-            self.visit(child)
-    
     def visit_class_definition(self, node):
         """访问类定义节点"""
         class_info = {
@@ -387,20 +349,12 @@ finally:
 print("示例代码：")
 print(code_control)
 
-class ControlFlowVisitor:
+class ControlFlowVisitor(walkde1.Visitor):
     def __init__(self):
         self.if_count = 0
         self.try_count = 0
         self.except_handlers = []
     
-    def visit(self, node):
-        method_name = f"visit_{node.type}"
-        if hasattr(self, method_name):
-            getattr(self, method_name)(node)
-        
-        for child in node.children:
-            self.visit(child)
-    
     def visit_if_statement(self, node):
         """访问 if 语句节点"""
         self.if_count += 1
@@ -451,34 +405,24 @@ for i in range(100):
 print("示例代码：")
 print(code_quality)
 
-class CodeQualityChecker:
+class CodeQualityChecker(walkde1.Visitor):
     def __init__(self):
         self.issues = []
-        self.in_loop = False
+        # 当前所在循环的层数，进入循环时加一、离开时减一
+        self.loop_depth = 0
     
-    def visit(self, node):
-        # 记录当前是否在循环中
-        was_in_loop = self.in_loop
-        
-        # 检查当前节点是否是循环
-        if node.type in ["for_statement", "while_statement"]:
-            self.in_loop = True
-        
-        # 访问当前节点
-        method_name = f"visit_{node.type}"
-        if hasattr(self, method_name):
-            getattr(self, method_name)(node)
-        
-        # 访问子节点
-        for child in node.children:
-            self.visit(child)
-        
-        # 恢复循环状态
-        self.in_loop = was_in_loop
+    def enter_for_statement(self, node):
+        self.loop_depth += 1
+    
+    def leave_for_statement(self, node):
+        self.loop_depth -= 1
+    
+    enter_while_statement = enter_for_statement
+    leave_while_statement = leave_for_statement
     
     def visit_call(self, node):
         """检查函数调用"""
-        if not self.in_loop:
+        if not self.loop_depth:
             return
         
         # 获取函数名
@@ -508,6 +452,21 @@ if checker.issues:
 else:
     print("  ✅ 未发现明显问题")
 
+# 同样的检查也可以写成查询：规则里的函数名合成一个 #any-of? 查询，匹配在 C 里完成，
+# 只有命中的调用点才回到 Python，规则再多也只扫一遍语法树
+import rulede1
+import tsrulede1
+
+query_rules = tsrulede1.QueryRuleSet([
+    rulede1.CallInContextRule("loop_connect", ["connect"], ["loop"], "在循环中调用 connect() 可能导致性能问题", "high"),
+    rulede1.CallInContextRule("loop_print", ["print"], ["loop"], "在循环中调用 print() 可能导致性能问题"),
+])
+print("\n编译出的查询：")
+print(query_rules.source)
+print("查询检查结果：")
+for violation in query_rules.check(code_quality):
+    print(f"  ⚠️  第 {violation['lineno']} 行 {violation['code']}：{violation['rule']}")
+
 # ========================================
 # 第7章：提取代码指纹
 # ========================================
@@ -536,7 +495,7 @@ def train_model(X, y):
 print("示例代码：")
 print(code_fingerprint)
 
-class CodeFingerprintExtractor:
+class CodeFingerprintExtractor(walkde1.Visitor):
     def __init__(self):
         self.fingerprint = {
             "imports": [],
@@ -545,14 +504,6 @@ class CodeFingerprintExtractor:
             "libraries_used": set()
         }
     
-    def visit(self, node):
-        method_name = f"visit_{node.type}"
-        if hasattr(self, method_name):
-            getattr(self, method_name)(node)
-        
-        for child in node.children:
-            self.visit(child)
-    
     def visit_import_statement(self, node):
         """访问 import 语句"""
         for child in node.children:
@@ -615,15 +566,16 @@ tree = parser.parse(bytes(code_strings, 'utf8'))
 print("\n提取字符串和注释：")
 print("字符串：")
 
-# 遍历所有节点，查找字符串
-for node, _ in tree.root_node.iter_fields():
-    if isinstance(node, tree_sitter.Node):
-        if node.type in ["string", "comment"]:
-            text = node.text.decode('utf8')
-            if node.type == "comment":
-                print(f"  注释: {text}")
-            else:
-                print(f"  字符串: {text}")
+# 遍历所有节点，查找字符串和注释（字符串的子节点不用再往下找）
+class StringCommentPrinter(walkde1.Visitor):
+    def enter_comment(self, node):
+        print(f"  注释: {node.text.decode('utf8')}")
+
+    def enter_string(self, node):
+        print(f"  字符串: {node.text.decode('utf8')}")
+        return False
+
+StringCommentPrinter().visit(tree.root_node)
 
 print("\n" + "=" * 80)
 print("Tree-sitter AST 库学习教程完成！")